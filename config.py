@@ -28,17 +28,62 @@ import os
 import socket
 import subprocess
 import re
+import shlex
+import sys
+import time
+import hashlib
+import math
+import json
+import mmap
+import struct
+import threading
+import array
+import glob
+import itertools
+import functools
+import bisect
+import traceback
+import collections
+import atexit
+import concurrent.futures
+import cairocffi
+import xcffib
+import xcffib.randr
+import xcffib.xproto
 from subprocess import check_output, call
 from libqtile.config import Key, Screen, Group, Drag, Click, Match
-from libqtile.command import lazy
+from libqtile.command import lazy, CommandError
 from libqtile import layout, bar, widget, hook
+from libqtile import pangocffi, xcbq, xkeysyms
+from libqtile.drawer import Drawer
+from libqtile.window import Internal, Window
 from libqtile.dgroups import simple_key_binder
+from libqtile.log_utils import logger
 
 #from libqtile import xcbq
 #xcbq.keysyms["Caps_Lock"] = 0xffe5
 
 from typing import List
 
+try:
+    import alsaaudio
+except ImportError:
+    alsaaudio = None
+
+try:
+    import xcffib.xkb
+except ImportError:
+    # XKB bindings are available only in newer xcffib
+    xkb = None
+else:
+    xkb = xcffib.xkb
+
+try:
+    import dbus
+    from dbus.mainloop.glib import DBusGMainLoop
+except ImportError:
+    dbus = None
+
 # Settings
 
 mod = "mod4"
@@ -110,14 +155,116 @@ layout_theme = {
 
 ##### WINDOW UTIL FUNCTIONS #####
 
+class WindowBatch(object):
+    """
+    Moves windows between groups laying out every affected group once.
+
+    Inside the with block layoutAll() of held groups (sources and targets
+    of moves, groups passed to hold()) is only recorded; when the block
+    ends, each of them which is on a screen is laid out once. Screen and
+    group switching done inside the block is deferred the same way.
+
+        with WindowBatch() as batch:
+            for window in windows:
+                batch.move(window, group)
+            batch.hold(*visible_groups(qtile))
+            qtile.currentScreen.setGroup(group)
+    """
+    def __init__(self):
+        self.groups = {}
+
+    def __enter__(self):
+        return self
+
+    def hold(self, *groups):
+        # Batches can nest: a group counts the batches holding it, and only
+        # the outermost one restores layoutAll() and lays the group out
+        for group in groups:
+            if group is not None and group not in self.groups:
+                self.groups[group] = None
+                depth = getattr(group, 'batch_depth', 0)
+                if not depth:
+                    group.batch_layout = None
+                    group.layoutAll = functools.partial(self._layout_all, group)
+                group.batch_depth = depth + 1
+
+    @staticmethod
+    def _layout_all(group, warp=False):
+        group.batch_layout = bool(group.batch_layout or warp)
+
+    def move(self, window, group, focus=False):
+        """window.togroup(), without giving the window focus by default"""
+        if window.group is group:
+            return
+        self.hold(window.group, group)
+        window.hide()
+        if window.group:
+            if window.group.screen:
+                # for floats remove window offset
+                window.x -= window.group.screen.x
+            window.group.remove(window)
+        if group.screen and window.x < group.screen.x:
+            window.x += group.screen.x
+        group.add(window, focus=focus)
+        self._layout_all(group)
+
+    def __exit__(self, *exc):
+        groups, self.groups = self.groups, {}
+        released = []
+        for group in groups:
+            group.batch_depth -= 1
+            if not group.batch_depth:
+                del group.layoutAll
+                released.append((group, group.batch_layout))
+        for group, warp in released:
+            if warp is not None and group.screen:
+                group.layoutAll(warp)
+
+
+def visible_groups(qtile):
+    return [screen.group for screen in qtile.screens]
+
+
+def move_windows(qtile, windows, group):
+    """
+    Move windows to group, return number of windows moved. Windows don't
+    get focus, unless group is shown and had no window to focus before.
+    """
+    if isinstance(group, str):
+        group = qtile.groupMap[group]
+    windows = [w for w in windows if w.group is not group]
+    focus = group.screen is not None and not group.windows
+    with WindowBatch() as batch:
+        for window in windows:
+            batch.move(window, group, focus=focus)
+            focus = False
+    return len(windows)
+
+
+def move_window(qtile, group, screen_index=None, switch_group=False):
+    """
+    Move current window to group, then show the group on current screen
+    or focus screen_index, all with one layout of affected groups
+    """
+    window = qtile.currentWindow
+    if window is None:
+        return
+    with WindowBatch() as batch:
+        batch.move(window, group, focus=True)
+        batch.hold(*visible_groups(qtile))
+        if switch_group:
+            qtile.currentScreen.setGroup(group)
+        if screen_index is not None:
+            qtile.cmd_to_screen(screen_index)
+
+
 @lazy.function
 def window_to_prev_group(qtile):
     if qtile.currentWindow is not None:
         i = qtile.groups.index(qtile.currentGroup)
         target_group = qtile.groups[i - 1]
-        qtile.currentWindow.togroup(target_group.name)
-        if switch_group_when_moving_window: 
-            qtile.currentScreen.setGroup(target_group)
+        move_window(qtile, target_group,
+                    switch_group=switch_group_when_moving_window)
 
 
 
@@ -126,9 +273,8 @@ def window_to_next_group(qtile):
     if qtile.currentWindow is not None:
         i = qtile.groups.index(qtile.currentGroup)
         target_group = qtile.groups[i + 1]
-        qtile.currentWindow.togroup(target_group.name)
-        if switch_group_when_moving_window: 
-            qtile.currentScreen.setGroup(target_group)
+        move_window(qtile, target_group,
+                    switch_group=switch_group_when_moving_window)
 
 
 def window_to_prev_screen():
@@ -140,9 +286,8 @@ def window_to_prev_screen():
                 index_target_screen = index - 1
             else:
                 index_target_screen = len(qtile.screens) - 1
-            qtile.currentWindow.togroup(qtile.screens[index_target_screen].group.name)
-            if switch_screen_when_moving_window: 
-                qtile.cmd_to_screen(index_target_screen)
+            move_window(qtile, qtile.screens[index_target_screen].group,
+                        index_target_screen if switch_screen_when_moving_window else None)
 
     return __inner
 
@@ -156,21 +301,81 @@ def window_to_next_screen():
                 index_target_screen = index + 1
             else:
                 index_target_screen = 0
-            qtile.currentWindow.togroup(qtile.screens[index_target_screen].group.name)
-            if switch_screen_when_moving_window: 
-                qtile.cmd_to_screen(index_target_screen)
+            move_window(qtile, qtile.screens[index_target_screen].group,
+                        index_target_screen if switch_screen_when_moving_window else None)
 
     return __inner
 
 
-def to_urgent(qtile):
-    cg = qtile.currentGroup
-    for group in qtile.groupMap.values():
-        if group == cg:
-            continue
-        if len([w for w in group.windows if w.urgent]) > 0:
-            qtile.currentScreen.setGroup(group)
+class UrgentWindows(object):
+    """
+    Urgent windows ordered by the time they became urgent.
+
+    Updated from client_urgent_hint_changed. Urgency qtile sets without
+    firing it (_NET_WM_STATE demands attention, activation request from
+    another screen) goes through the Window.urgent setter, which install()
+    wraps to update the window when its urgency changes. Focused and
+    killed windows are dropped.
+    """
+    def __init__(self):
+        self.windows = collections.OrderedDict()
+        self.installed = False
+
+    def install(self):
+        if self.installed:
             return
+        self.installed = True
+        urgent = Window.urgent
+
+        def set_urgent(window, value):
+            was_urgent = urgent.fget(window)
+            urgent.fset(window, value)
+            if urgent.fget(window) != was_urgent:
+                self.update(window)
+        Window.urgent = property(urgent.fget, set_urgent)
+
+    def update(self, window):
+        """Add window if it became urgent (keeping its place if already in)"""
+        if window.urgent:
+            self.windows.setdefault(window, None)
+        else:
+            self.discard(window)
+
+    def discard(self, window):
+        self.windows.pop(window, None)
+
+    def latest(self):
+        """Most recently urgent window, or None"""
+        while self.windows:
+            window = next(reversed(self.windows))
+            if window.urgent and window.group is not None:
+                return window
+            self.discard(window)
+        return None
+
+    def after(self, window):
+        """Next urgent window older than window, cycling to the latest"""
+        windows = [w for w in self.windows if w.urgent and w.group is not None]
+        if window in windows:
+            return windows[windows.index(window) - 1]
+        return windows[-1] if windows else None
+
+
+urgent_windows = UrgentWindows()
+
+
+def to_urgent(qtile):
+    """Focus the window which became urgent most recently"""
+    window = urgent_windows.latest()
+    if window is not None:
+        focus_window(qtile, window)
+
+
+def cycle_urgent(qtile):
+    """Focus urgent windows one by one, from the most recent"""
+    window = urgent_windows.after(qtile.currentWindow)
+    if window is not None:
+        focus_window(qtile, window)
 
 
 class swap_group(object):
@@ -188,6 +393,146 @@ class swap_group(object):
             qtile.currentScreen.setGroup(self.last_group)
 
 
+def focus_window(qtile, window):
+    """
+    Focus window, showing its group on current screen or switching to
+    the screen where the group already is. Group is laid out once.
+    """
+    group = window.group
+    if group is None:
+        return False
+    if group.screen is not None and group.screen is not qtile.currentScreen:
+        # focus() and toScreen() would both lay the group out
+        with WindowBatch() as batch:
+            batch.hold(group)
+            group.focus(window, False)
+            qtile.toScreen(group.screen.index, False)
+        return True
+    # Make it current window of the group first, so group is shown
+    # with it already on top
+    group.focus(window, False)
+    if group.screen is None:
+        qtile.currentScreen.setGroup(group)
+    return True
+
+
+def install_commands(qtile):
+    """Add config specific commands to the root command object"""
+    def cmd_focus_window(wid):
+        """Focus window by id, switching group and screen as needed"""
+        window = qtile.windowMap.get(wid)
+        return window is not None and focus_window(qtile, window)
+    qtile.cmd_focus_window = cmd_focus_window
+
+    def cmd_set_kbdd_layout(index):
+        """Switch keyboard layout by its index in kbdd"""
+        kbdd.set_layout(int(index))
+    qtile.cmd_set_kbdd_layout = cmd_set_kbdd_layout
+
+    def cmd_perf_stats():
+        """Call counts and latencies of hooks, key commands and widgets"""
+        return perf.report()
+    qtile.cmd_perf_stats = cmd_perf_stats
+
+    def cmd_perf_dump(path=None):
+        """Write perf_stats as JSON to path, returns the path"""
+        return perf.dump(path)
+    qtile.cmd_perf_dump = cmd_perf_dump
+
+    def cmd_perf_reset():
+        """Clear collected perf_stats"""
+        perf.reset()
+    qtile.cmd_perf_reset = cmd_perf_reset
+
+    def cmd_move_windows(to_group, classes=None, from_group=None):
+        """
+        Move windows of any WM_CLASS in classes (a list or a single class)
+        and/or all windows of from_group to to_group, laying out every
+        affected group once
+        """
+        for name in (to_group, from_group):
+            if name is not None and name not in qtile.groupMap:
+                raise CommandError("No such group: %s" % name)
+        if isinstance(classes, str):
+            classes = [classes]
+        windows = []
+        if classes:
+            windows += window_index.windows(qtile, classes)
+        if from_group is not None:
+            windows += list(qtile.groupMap[from_group].windows)
+        return move_windows(qtile, windows, to_group)
+    qtile.cmd_move_windows = cmd_move_windows
+
+
+class WindowClassIndex(object):
+    """
+    Managed windows indexed by both parts of WM_CLASS (instance and class),
+    the same values window.match(wmclass=...) compares against.
+    Kept current by client_new/client_killed hooks.
+    """
+    def __init__(self):
+        # wm_class -> {window: None}, ordered by creation time
+        self.by_class = {}
+        self.classes = {}
+        self.built = False
+
+    def add(self, window):
+        try:
+            classes = window.window.get_wm_class() or ()
+        except (xcffib.xproto.WindowError, xcffib.xproto.AccessError):
+            return
+        self.remove(window)
+        self.classes[window] = classes
+        for c in classes:
+            self.by_class.setdefault(c, {})[window] = None
+
+    def remove(self, window):
+        for c in self.classes.pop(window, ()):
+            windows = self.by_class.get(c)
+            if windows is not None:
+                windows.pop(window, None)
+                if not windows:
+                    del self.by_class[c]
+
+    def build(self, qtile):
+        # Windows which were managed before our hooks were subscribed
+        for window in qtile.windowMap.values():
+            if window not in self.classes:
+                self.add(window)
+        self.built = True
+
+    def find(self, qtile, classes, group=""):
+        """
+        Return window matching any of classes. Window on the group is
+        preferred, otherwise the most recently created one is returned.
+        """
+        if not self.built:
+            self.build(qtile)
+        window_found = None
+        for c in classes:
+            for window in self.by_class.get(c, ()):
+                if window.group is None:
+                    continue
+                if group and window.group.name == group:
+                    return window
+                window_found = window
+        return window_found
+
+    def windows(self, qtile, classes):
+        """All managed windows matching any of classes, oldest first"""
+        if not self.built:
+            self.build(qtile)
+        found = {}
+        for c in classes:
+            for window in self.by_class.get(c, ()):
+                if window.group is not None:
+                    found[window] = None
+        return list(found)
+
+
+window_index = WindowClassIndex()
+
+
 '''
   Find application if it is already launched and focus it on the current screen.
   If multiple windows are found - prefer focusing those belonging to the specified group.
@@ -196,9 +541,11 @@ class swap_group(object):
 
   Original source: https://github.com/qtile/qtile-examples/blob/master/mort65/config.py
   Modified by Soulmare:
-    * Compatibility with Ubuntu (different location of ps util)
     * Go to group
     * Prefer window if group specified
+    * Look up processes in process_table instead of running ps
+    * Look up windows in window_index instead of walking windowMap
+    * Focus a window of a matching process if none matched by class
 '''
 def find_or_run(app, classes=(), group="", processes=()):
     if not processes:
@@ -208,42 +555,26 @@ def find_or_run(app, classes=(), group="", processes=()):
         classes = (app[0], ) if isinstance(app, list) else (app, )
 
     def __inner(qtile):
-        window_found = None
-        for window in qtile.windowMap.values():
-            for c in classes:
-                if window.group and window.match(wmclass=c):
-                    window_found = window
-            if group and window_found and group == window_found.group.name:
-                # If window was found on it's preferred group, stop search.
-                # Otherwise, continue search to the end.
-                # Doing so, we can select which window to focus
-                # if multiple windows were matched.
-                break
+        window_found = window_index.find(qtile, classes, group)
         if window_found:
-            qtile.currentScreen.setGroup(window_found.group)
-            window_found.group.focus(window_found, False)
+            focus_window(qtile, window_found)
             return
 
         if group:
-            if os.path.isfile('/usr/bin/ps'):
-                ps = '/usr/bin/ps'
-            elif os.path.isfile('/bin/ps'):
-                ps = '/bin/ps'
-            else:
-                # ps not found. maybe, should be better to raise an exception here..
-                return
-            lines = subprocess.check_output([ps, "axw"]).decode("utf-8").splitlines()
-            ls = [line.split()[4:] for line in lines][1:]
-            ps = [' '.join(l) for l in ls]
-            for p in ps:
-                for process in processes:
-                    if re.match(process, p):
-                        qtile.groupMap[group].cmd_toscreen()
-                        return
+            for process in processes:
+                # Window of the app with another WM_CLASS
+                windows = window_processes.windows(process)
+                if windows:
+                    focus_window(qtile, next((w for w in windows if w.group and
+                                              w.group.name == group), windows[0]))
+                    return
+                if process_table.match(process):
+                    qtile.groupMap[group].cmd_toscreen()
+                    return
             for check_group in qtile.groups:
                 if check_group.name == group:
                     qtile.currentScreen.setGroup(check_group)
-        subprocess.Popen(app.split())
+        spawn_server.spawn(app.split())
 
     return __inner
 
@@ -259,37 +590,1274 @@ def group_to_screen_by_index(index, screen_index=None):
 def window_to_group_by_index(index, screen_index=None):
     def __inner(qtile):
         if index >= 0 and index < len(qtile.groups):
-            if qtile.currentWindow is not None:
-                qtile.currentWindow.togroup(qtile.groups[index].name)
-                if switch_group_when_moving_window: 
-                    #qtile.currentScreen.setGroup(qtile.groups[index])
-                    qtile.groups[index].cmd_toscreen(screen_index)
-                    current_screen_index = qtile.screens.index(qtile.currentScreen)
-                    if switch_screen_when_moving_window and screen_index and current_screen_index != screen_index:
-                        qtile.cmd_to_screen(screen_index)
+            window = qtile.currentWindow
+            if window is not None:
+                group = qtile.groups[index]
+                with WindowBatch() as batch:
+                    batch.move(window, group, focus=True)
+                    if switch_group_when_moving_window:
+                        batch.hold(*visible_groups(qtile))
+                        #qtile.currentScreen.setGroup(qtile.groups[index])
+                        group.cmd_toscreen(screen_index)
+                        current_screen_index = qtile.screens.index(qtile.currentScreen)
+                        if switch_screen_when_moving_window and screen_index and current_screen_index != screen_index:
+                            qtile.cmd_to_screen(screen_index)
 
     return __inner
 
 
+def keysym_to_string(keysym):
+    """
+    Character typed by keysym, or None: Latin-1 and Unicode keysyms, and
+    legacy Cyrillic keysyms of ru/ua layouts (KOI8 order)
+    """
+    if 0x20 <= keysym < 0x7f or 0xa0 <= keysym <= 0xff:
+        return chr(keysym)
+    if 0x1000100 <= keysym <= 0x110ffff:
+        return chr(keysym - 0x1000000)
+    if keysym >> 8 == 0x06:
+        code = keysym & 0xff
+        if code >= 0xc0:
+            return bytes([code]).decode('koi8_r')
+        if code in b'\xa3\xa4\xa6\xa7\xad\xb3\xb4\xb6\xb7\xbd':
+            return bytes([code]).decode('koi8_u')
+    return None
+
+
+class WindowSwitcher(object):
+    """
+    Window picker drawn by qtile itself, replacement for running
+    dmenu-qtile-windowlist.py on every keypress.
+
+    Windows are tracked by client_managed/client_killed hooks. The popup
+    window is created on first use and then only shown/hidden, keyboard is
+    grabbed while it is shown. Typing (in current keyboard layout) filters
+    the list (case insensitive substring), Up/Down select, Return focuses
+    selected window, Escape closes.
+    """
+    def __init__(self, width=800, lines=20, font="Ubuntu", fontsize=13,
+                 colors=("#252525", "#CCCCCC", "#AA2A2A", "#C3C300")):
+        self.width = width
+        self.lines = lines
+        self.font = font
+        self.fontsize = fontsize
+        self.row_height = int(fontsize * 1.6)
+        self.bg, self.fg, self.sel_bg, self.sel_fg = colors
+        self.windows = {}
+        self.built = False
+        self.qtile = None
+        self.popup = None
+        self.visible = False
+        self.text = ""
+        self.matches = []
+        self.selected = 0
+        self.saved_focus = None
+
+    def add(self, window):
+        self.windows[window] = None
+
+    def remove(self, window):
+        self.windows.pop(window, None)
+        if self.visible and window in self.matches:
+            self.filter()
+            self.draw()
+
+    def _create(self, qtile):
+        self.qtile = qtile
+        height = self.row_height * (self.lines + 1)
+        self.popup = Internal.create(qtile, 0, 0, self.width, height)
+        self.popup.handle_KeyPress = self.handle_KeyPress
+        self.popup.handle_Expose = lambda e: self.draw()
+        qtile.windowMap[self.popup.window.wid] = self.popup
+        if xkb is not None:
+            # XKB aware connection gets keyboard group in KeyPress state
+            try:
+                qtile.conn.conn(xkb.key).UseExtension(1, 0).reply()
+            except Exception:
+                logger.exception('cannot enable XKB, only first layout is typed')
+        self.drawer = Drawer(qtile, self.popup.window.wid, self.width, height)
+        self.layouts = []
+        for i in range(self.lines + 1):
+            layout = self.drawer.textlayout("", self.fg, self.font, self.fontsize,
+                                            None, wrap=False)
+            layout.layout.set_alignment(pangocffi.ALIGN_LEFT)
+            layout.width = self.width - 10
+            self.layouts.append(layout)
+
+    def show(self, qtile):
+        if self.popup is None:
+            self._create(qtile)
+        if not self.built:
+            for window in qtile.windowMap.values():
+                if window.group is not None and not isinstance(window, Internal):
+                    self.add(window)
+            self.built = True
+        self.text = ""
+        self.filter()
+        screen = qtile.currentScreen
+        height = self.row_height * (self.lines + 1)
+        self.popup.place(screen.x + (screen.width - self.width) // 2,
+                         screen.y + (screen.height - height) // 3,
+                         self.width, height, 0, None, above=True)
+        self.popup.unhide()
+        self.saved_focus = qtile.currentWindow
+        self.popup.window.set_input_focus()
+        status = qtile.conn.conn.core.GrabKeyboard(
+            False, self.popup.window.wid, xcffib.xproto.Time.CurrentTime,
+            xcffib.xproto.GrabMode.Async, xcffib.xproto.GrabMode.Async).reply().status
+        if status != xcffib.xproto.GrabStatus.Success:
+            logger.warning('cannot grab keyboard for window switcher: %d', status)
+        self.visible = True
+        self.draw()
+
+    def hide(self):
+        self.qtile.conn.conn.core.UngrabKeyboard(xcffib.xproto.Time.CurrentTime)
+        self.popup.hide()
+        self.visible = False
+        if self.saved_focus is not None and self.saved_focus in self.windows:
+            self.saved_focus.window.set_input_focus()
+        self.saved_focus = None
+
+    def label(self, window):
+        return "%s (%s)" % (window.name, window.group.name)
+
+    def filter(self):
+        text = self.text.lower()
+        self.matches = [w for w in self.windows
+                        if w.group is not None and text in self.label(w).lower()]
+        self.selected = 0
+
+    def draw(self):
+        if not self.visible:
+            return
+        self.drawer.clear(self.bg)
+        prompt = self.layouts[0]
+        prompt.text = "window >>> " + self.text
+        prompt.colour = self.sel_fg
+        prompt.draw(5, (self.row_height - prompt.height) // 2)
+        first = max(0, self.selected - self.lines + 1)
+        for row, window in enumerate(self.matches[first:first + self.lines], 1):
+            layout = self.layouts[row]
+            layout.text = self.label(window)
+            if first + row - 1 == self.selected:
+                self.drawer.set_source_rgb(self.sel_bg)
+                self.drawer.fillrect(0, row * self.row_height, self.width,
+                                     self.row_height, 0)
+                layout.colour = self.sel_fg
+            else:
+                layout.colour = self.fg
+            layout.draw(5, row * self.row_height + (self.row_height - layout.height) // 2)
+        self.drawer.draw(0, 0, self.width, self.row_height * (self.lines + 1))
+
+    def keysym(self, e):
+        # Core keymap has two levels per group (as in us/ru/ua layouts),
+        # XKB group is in bits 13-14 of state
+        syms = self.qtile.conn.code_to_syms[e.detail]
+        level = 1 if e.state & (xcbq.ModMasks["shift"] | xcbq.ModMasks["lock"]) else 0
+        column = 2 * ((e.state >> 13) & 3) + level
+        if column < len(syms) and syms[column]:
+            return syms[column]
+        return syms[level]
+
+    def handle_KeyPress(self, e):
+        keysym = self.keysym(e)
+        if keysym == xkeysyms.keysyms['Escape']:
+            self.hide()
+            return
+        elif keysym in (xkeysyms.keysyms['Return'], xkeysyms.keysyms['KP_Enter']):
+            window = self.matches[self.selected] if self.matches else None
+            self.saved_focus = None
+            self.hide()
+            if window is not None:
+                focus_window(self.qtile, window)
+            return
+        elif keysym in (xkeysyms.keysyms['Down'], xkeysyms.keysyms['Tab']):
+            self.selected = min(self.selected + 1, len(self.matches) - 1)
+        elif keysym == xkeysyms.keysyms['Up']:
+            self.selected = max(self.selected - 1, 0)
+        elif keysym == xkeysyms.keysyms['BackSpace']:
+            self.text = self.text[:-1]
+            self.filter()
+        elif keysym_to_string(keysym) is not None:
+            self.text += keysym_to_string(keysym)
+            self.filter()
+        else:
+            return
+        self.draw()
+
+
+window_switcher = WindowSwitcher(colors=(colors[14][0], colors[13][0],
+                                         colors[14][1], colors[13][1]))
+
+
+class WindowStateFile(object):
+    """
+    Snapshot of windows, groups and screens in a memory-mapped file,
+    for external scripts which would otherwise poll qtile over IPC.
+
+    File starts with header struct "<4sQI": magic b"QTWS", version counter
+    and length of JSON payload which follows. Counter is odd while the file
+    is being written; reader should retry if it is odd or has changed while
+    reading the payload (see dmenu-qtile-windowlist.py).
+
+    Hooks mark the windows they concern dirty, or only the groups/screens
+    sections; a window's info is refreshed only when it may have changed
+    (its group changed, it got focus or its group was laid out). All changes
+    from one event loop iteration are written at once.
+    """
+    header = struct.Struct("<4sQI")
+    magic = b"QTWS"
+
+    def __init__(self, path, size=64 * 1024):
+        self.path = path
+        self.size = size
+        self.mm = None
+        self.version = 0
+        self.windows = {}
+        self.window_groups = {}
+        self.groups = []
+        self.screens = []
+        self.dirty_windows = set()
+        self.dirty_groups = True
+        self.dirty_all = True
+        self.scheduled = False
+
+    def _open(self):
+        # Path can be in /tmp: never follow a symlink planted there, and only
+        # use a file that is ours
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW | os.O_CLOEXEC,
+                     0o600)
+        try:
+            if os.fstat(fd).st_uid != os.getuid():
+                raise PermissionError('%s is not owned by us' % self.path)
+            os.ftruncate(fd, self.size)
+            self.mm = mmap.mmap(fd, self.size)
+        finally:
+            os.close(fd)
+
+    def window_changed(self, window):
+        self.dirty_windows.add(window)
+        self._schedule()
+
+    def window_killed(self, window):
+        self.windows.pop(window.window.wid, None)
+        self.window_groups.pop(window.window.wid, None)
+        self.dirty_windows.discard(window)
+        self.groups_changed()
+
+    def focus_changed(self):
+        window = hook.qtile.currentWindow if hook.qtile is not None else None
+        if window is not None:
+            self.dirty_windows.add(window)
+        self.groups_changed()
+
+    def groups_changed(self, *args):
+        self.dirty_groups = True
+        self._schedule()
+
+    def layout_changed(self, *args):
+        # Geometry of windows on screens may have changed
+        if hook.qtile is not None:
+            for screen in hook.qtile.screens:
+                if screen.group is not None:
+                    self.dirty_windows.update(screen.group.windows)
+        self.groups_changed()
+
+    def _schedule(self):
+        if not self.scheduled and hook.qtile is not None:
+            self.scheduled = True
+            hook.qtile.call_soon(self.flush)
+
+    def _window_info(self, window):
+        info = window.info()
+        info["urgent"] = window.urgent
+        info["wm_class"] = window_index.classes.get(window, ())
+        return info
+
+    def flush(self):
+        self.scheduled = False
+        qtile = hook.qtile
+        if self.dirty_all:
+            self.windows = {wid: self._window_info(w) for wid, w in qtile.windowMap.items()
+                            if w.group is not None and not isinstance(w, Internal)}
+            self.window_groups = {wid: info["group"] for wid, info in self.windows.items()}
+            self.dirty_windows.clear()
+        elif self.dirty_groups:
+            # Windows moved to another group
+            for group in qtile.groups:
+                for window in group.windows:
+                    if self.window_groups.get(window.window.wid) != group.name:
+                        self.dirty_windows.add(window)
+        for window in self.dirty_windows:
+            wid = window.window.wid
+            if window.group is not None and wid in qtile.windowMap:
+                self.windows[wid] = self._window_info(window)
+                self.window_groups[wid] = window.group.name
+        if self.dirty_groups or self.dirty_all:
+            self.groups = [dict(name=g.name, screen=g.screen.index if g.screen else None,
+                                layout=g.layout.name,
+                                focus=g.currentWindow.window.wid if g.currentWindow else None,
+                                windows=[w.window.wid for w in g.windows])
+                           for g in qtile.groups]
+            self.screens = [dict(index=sc.index, x=sc.x, y=sc.y, width=sc.width,
+                                 height=sc.height, group=sc.group.name if sc.group else None)
+                            for sc in qtile.screens]
+        self.dirty_windows.clear()
+        self.dirty_groups = self.dirty_all = False
+        state = dict(
+            windows=list(self.windows.values()),
+            groups=self.groups,
+            screens=self.screens,
+            current_screen=qtile.currentScreen.index,
+        )
+        self.write(json.dumps(state, separators=(',', ':')).encode())
+
+    def write(self, payload):
+        if self.mm is None:
+            self._open()
+        needed = self.header.size + len(payload)
+        if needed > self.size:
+            self.size = max(needed, self.size * 2)
+            self.mm.close()
+            self._open()
+        self.version += 1
+        self.header.pack_into(self.mm, 0, self.magic, self.version, 0)
+        self.mm[self.header.size:needed] = payload
+        self.version += 1
+        self.header.pack_into(self.mm, 0, self.magic, self.version, len(payload))
+
+
+window_state = WindowStateFile(os.path.join(
+    os.environ.get('XDG_RUNTIME_DIR', '/tmp'),
+    'qtile-state' + os.environ.get('DISPLAY', '')))
+
+
 #### OTHER FUNCTIONS ####
 
+class BufferedLog(object):
+    """
+    Log file written from a background thread.
+
+    write() only queues the line, the thread writes queued lines in one go
+    every `flush_interval` seconds into the file it keeps open. The file is
+    rotated to path.1 ... path.<backups> when it grows over `max_bytes`.
+    If more than `max_queue` lines wait (slow disk), new lines are dropped
+    and their count is logged instead. Queued lines are flushed at exit,
+    and by install() before qtile finalizes, since restart replaces the
+    process by os.execv and skips atexit.
+    """
+    def __init__(self, path, max_bytes=1024 * 1024, backups=2,
+                 max_queue=10000, flush_interval=1.0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.max_queue = max_queue
+        self.flush_interval = flush_interval
+        self.queue = collections.deque()
+        self.dropped = 0
+        self.file = None
+        # lock guards queue and dropped, file_lock the file; write() never
+        # waits for disk
+        self.lock = threading.Lock()
+        self.file_lock = threading.Lock()
+        self.thread = None
+
+    def write(self, line):
+        with self.lock:
+            if len(self.queue) >= self.max_queue:
+                self.dropped += 1
+                return
+            self.queue.append((time.time(), line))
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+            atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('cannot write %s', self.path)
+
+    def flush(self):
+        with self.file_lock:
+            with self.lock:
+                queued, self.queue = self.queue, collections.deque()
+                dropped, self.dropped = self.dropped, 0
+            lines = ['%s %s\n' % (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(stamp)),
+                                  line)
+                     for stamp, line in queued]
+            if dropped:
+                lines.append('%d lines dropped\n' % dropped)
+            if not lines:
+                return
+            if self.file is None:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                self.file = open(self.path, 'a')
+            self.file.write(''.join(lines))
+            self.file.flush()
+            if self.file.tell() > self.max_bytes:
+                self.rotate()
+
+    def install(self, qtile):
+        stock_finalize = qtile.finalize
+
+        def finalize():
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('cannot write %s', self.path)
+            stock_finalize()
+        qtile.finalize = finalize
+
+    def rotate(self):
+        self.file.close()
+        self.file = None
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists('%s.%d' % (self.path, i)):
+                os.replace('%s.%d' % (self.path, i), '%s.%d' % (self.path, i + 1))
+        if self.backups:
+            os.replace(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+
+
+config_log_path = home + '/.cache/qtile-config.log'
+config_log = BufferedLog(config_log_path)
+
+
 def my_log(s):
-    with open('/home/alx/qtile2.log', 'a') as file:
-        file.write(s)
-        file.write("\n")
+    config_log.write(s)
 
 
-def is_running(process):
-    s = subprocess.Popen(["ps", "axuw"], stdout=subprocess.PIPE)
-    for x in s.stdout:
-        if re.search(process, x.decode("utf-8")):
+class ProcessTable(object):
+    """
+    Process table read straight from /proc, used instead of forking ps.
+
+    A rescan only lists /proc and reads new PIDs, processes which are gone
+    are dropped. cmdline(pid) also checks the start time, so a PID reused
+    since it was read is read again. The table is rescanned at most once
+    per `ttl` seconds, so repeated queries are answered from memory.
+    """
+    def __init__(self, proc='/proc', ttl=0.5):
+        self.proc = proc
+        self.ttl = ttl
+        self.cmdlines = {}
+        self.starts = {}
+        self.updated = None
+
+    def _read_start(self, pid):
+        """Start time of pid (field 22 of /proc/<pid>/stat), or None"""
+        try:
+            with open(os.path.join(self.proc, str(pid), 'stat'), 'rb') as f:
+                stat = f.read()
+            # comm (field 2) may contain spaces and parentheses
+            return int(stat[stat.rindex(b')') + 2:].split()[19])
+        except (OSError, ValueError, IndexError):
+            return None
+
+    def _read_cmdline(self, pid):
+        path = os.path.join(self.proc, str(pid))
+        try:
+            with open(path + '/cmdline', 'rb') as f:
+                args = f.read().rstrip(b'\0').split(b'\0')
+            if args == [b'']:
+                # Kernel thread, show it like ps does
+                with open(path + '/comm', 'rb') as f:
+                    args = [b'[' + f.read().strip() + b']']
+        except OSError:
+            # Process has exited while we were reading it
+            return None
+        return b' '.join(args).decode('utf-8', 'replace')
+
+    def _update(self, pid):
+        start = self._read_start(pid)
+        if start is None:
+            self._drop(pid)
+            return None
+        if self.starts.get(pid) != start or pid not in self.cmdlines:
+            cmdline = self._read_cmdline(pid)
+            if cmdline is None:
+                self._drop(pid)
+                return None
+            self.cmdlines[pid] = cmdline
+            self.starts[pid] = start
+        return self.cmdlines[pid]
+
+    def _drop(self, pid):
+        self.cmdlines.pop(pid, None)
+        self.starts.pop(pid, None)
+
+    def cmdline(self, pid):
+        return self._update(pid)
+
+    def refresh(self, force=False):
+        now = time.monotonic()
+        if not force and self.updated is not None \
+                and now - self.updated < self.ttl:
+            return
+        pids = {int(name) for name in os.listdir(self.proc) if name.isdigit()}
+        for pid in self.cmdlines.keys() - pids:
+            self._drop(pid)
+        for pid in pids - self.cmdlines.keys():
+            self._update(pid)
+        self.updated = now
+
+    def match(self, pattern):
+        self.refresh()
+        test = re.compile(pattern).match
+        return any(test(cmdline) for cmdline in self.cmdlines.values())
+
+    def search(self, pattern):
+        self.refresh()
+        test = re.compile(pattern).search
+        return any(test(cmdline) for cmdline in self.cmdlines.values())
+
+
+process_table = ProcessTable()
+
+
+class WindowProcesses(object):
+    """
+    PID (from _NET_WM_PID) and command line of every managed window,
+    filled by client_new and dropped by client_killed hooks.
+    Lets us answer "is this app running" without scanning all processes.
+    """
+    def __init__(self):
+        self.cmdlines = {}
+
+    def add(self, window):
+        try:
+            pid = window.window.get_net_wm_pid()
+        except (xcffib.xproto.WindowError, xcffib.xproto.AccessError):
+            return
+        if not pid:
+            return
+        cmdline = process_table.cmdline(pid)
+        if cmdline is not None:
+            self.cmdlines[window] = cmdline
+
+    def remove(self, window):
+        self.cmdlines.pop(window, None)
+
+    def search(self, pattern):
+        test = re.compile(pattern).search
+        return any(test(cmdline) for cmdline in self.cmdlines.values())
+
+    def windows(self, pattern):
+        """Return windows owned by processes matching pattern"""
+        test = re.compile(pattern).match
+        return [w for w, cmdline in self.cmdlines.items() if test(cmdline)]
+
+
+window_processes = WindowProcesses()
+
+
+class WindowRules(object):
+    """
+    floating_layout float rules and Group matches compiled for classifying
+    new windows in one pass.
+
+    String rules are looked up in dicts by exact value (the stock Match
+    also accepts values which are a substring of the rule). Regex rules
+    of each field are joined in one regex, its first alternative matching
+    wins, like the first matching rule does in dgroups. Matches with
+    fields not indexed here (net_wm_pid) are left to dgroups.
+    """
+    fields = ('title', 'wm_class', 'wm_instance_class', 'role', 'wm_type')
+    regex_flags = ((re.I, 'i'), (re.M, 'm'), (re.S, 's'), (re.X, 'x'))
+
+    def __init__(self, float_rules, groups):
+        self.float_rules = {'wmclass': set(), 'wname': set(), 'role': set()}
+        for rule in float_rules:
+            for key, value in rule.items():
+                if key not in self.float_rules:
+                    # Window.match() takes only these, keys of a rule are OR'ed
+                    logger.warning('float rule %r: unknown key %r ignored', rule, key)
+                    continue
+                self.float_rules[key].add(value)
+
+        # field -> {value: (rule order, group name)}
+        self.exact = dict((field, {}) for field in self.fields)
+        patterns = dict((field, []) for field in self.fields)
+        self.matches = set()
+        order = 0
+        for group in groups:
+            for match in group.matches:
+                if any(field not in self.fields for field, _ in match._rules):
+                    continue
+                self.matches.add(match)
+                for field, rule in match._rules:
+                    if isinstance(rule, str):
+                        self.exact[field].setdefault(rule, (order, group.name))
+                    else:
+                        patterns[field].append((order, group.name, rule))
+                order += 1
+        self.patterns = dict((field, self._combine(p))
+                             for field, p in patterns.items() if p)
+        self.wm_classes = {}
+
+    def _combine(self, patterns):
+        """Return (regex, {group index: (order, group name)})"""
+        parts = []
+        for i, (order, group, pattern) in enumerate(patterns):
+            flags = ''.join(c for flag, c in self.regex_flags if pattern.flags & flag)
+            parts.append('(?P<r%d>(?%s:%s))' % (i, flags, pattern.pattern))
+        try:
+            regex = re.compile('|'.join(parts))
+        except re.error:
+            # Pattern using global flags or named groups, match them one by one
+            return None, patterns
+        return regex, dict((regex.groupindex['r%d' % i], p[:2])
+                           for i, p in enumerate(patterns))
+
+    def _search(self, field, value):
+        regex, rules = self.patterns[field]
+        if regex is None:
+            return next((p[:2] for p in rules if p[2].match(value)), None)
+        m = regex.match(value)
+        return rules[m.lastindex] if m else None
+
+    def wm_class(self, window):
+        wid = window.window.wid
+        if wid not in self.wm_classes:
+            self.wm_classes[wid] = window.window.get_wm_class() or ()
+        return self.wm_classes[wid]
+
+    def forget(self, window):
+        self.wm_classes.pop(window.window.wid, None)
+
+    def group(self, window):
+        """Name of the group window should be placed to, or None"""
+        try:
+            wm_class = self.wm_class(window)
+            values = {
+                'title': window.name,
+                'wm_instance_class': wm_class[0] if wm_class else None,
+                'wm_class': wm_class[1] if len(wm_class) > 1 else None,
+            }
+            # Only ask X for what some rule looks at
+            if self.exact['role'] or 'role' in self.patterns:
+                values['role'] = window.window.get_wm_window_role()
+            if self.exact['wm_type'] or 'wm_type' in self.patterns:
+                values['wm_type'] = window.window.get_wm_type()
+        except (xcffib.xproto.WindowError, xcffib.xproto.AccessError):
+            return None
+        best = None
+        for field, value in values.items():
+            if value is None:
+                continue
+            hits = [self.exact[field].get(value)]
+            if field in self.patterns:
+                hits.append(self._search(field, value))
+            for hit in hits:
+                if hit is not None and (best is None or hit < best):
+                    best = hit
+        return best[1] if best else None
+
+    def floats(self, window):
+        """Whether window matches some float rule"""
+        if window.name in self.float_rules['wname']:
             return True
-    return False
+        try:
+            if self.float_rules['wmclass'].intersection(self.wm_class(window)):
+                return True
+            return bool(self.float_rules['role']) and \
+                window.window.get_wm_window_role() in self.float_rules['role']
+        except (xcffib.xproto.WindowError, xcffib.xproto.AccessError):
+            return False
+
+    def place(self, qtile, window):
+        """Move new window to its group, as dgroups would"""
+        # dgroups leaves windows which have a group (restart, rescan) alone
+        if window.group is not None:
+            return
+        name = self.group(window)
+        if name is None:
+            return
+        dgroup = qtile.dgroups.groupMap.get(name)
+        added = qtile.addGroup(name, dgroup.layout, dgroup.layouts, dgroup.label)
+        window.togroup(name)
+        if added:
+            group = qtile.groupMap[name]
+            for key, value in dgroup.layout_opts.items():
+                if callable(value):
+                    value(group.layout)
+                else:
+                    setattr(group.layout, key, value)
+            affinity = dgroup.screen_affinity
+            if affinity and len(qtile.screens) > affinity:
+                qtile.screens[affinity].setGroup(group)
+            qtile.dgroups.sort_groups()
+
+    def install(self, qtile):
+        """Leave to dgroups only the rules which are not indexed"""
+        qtile.dgroups.rules = [rule for rule in qtile.dgroups.rules
+                               if rule.match not in self.matches]
+
+
+class IndexedFloating(layout.Floating):
+    """Floating layout matching float rules through window_rules"""
+    def match(self, win):
+        if win.window.get_wm_type() in self.auto_float_types:
+            return True
+        return window_rules.floats(win)
+
+
+def is_running(process):
+    # Apps with windows are answered from window_processes,
+    # process table is scanned only for windowless daemons.
+    return window_processes.search(process) or process_table.search(process)
+
+
+class SpawnServer(object):
+    """
+    Client of spawn-server.py, small helper process which starts programs
+    for us, so launching an app doesn't fork the whole qtile process.
+    Falls back to subprocess if helper can't be started.
+    """
+    def __init__(self, script, log_path):
+        self.script = script
+        self.log_path = log_path
+        self.proc = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.proc is None or self.proc.poll() is not None:
+                # Errors of the helper (e.g. command not found) go to log_path
+                os.makedirs(os.path.dirname(self.log_path), exist_ok=True)
+                with open(self.log_path, 'ab') as log:
+                    self.proc = subprocess.Popen([sys.executable, self.script],
+                                                 stdin=subprocess.PIPE,
+                                                 stdout=subprocess.DEVNULL,
+                                                 stderr=log)
+
+    def spawn(self, cmd):
+        args = shlex.split(cmd) if isinstance(cmd, str) else list(cmd)
+        # One write of a short line is atomic, so threads can share the pipe
+        line = (json.dumps(args) + "\n").encode()
+        for attempt in range(2):
+            try:
+                if self.proc is None or self.proc.poll() is not None:
+                    self.start()
+                os.write(self.proc.stdin.fileno(), line)
+                return
+            except OSError as e:
+                logger.warning('spawn server failed: %s', e)
+        subprocess.Popen(args, start_new_session=True, stdin=subprocess.DEVNULL)
+
+
+spawn_server = SpawnServer(home + '/.config/qtile/spawn-server.py',
+                           home + '/.cache/qtile-spawn-server.log')
+
+
+def spawn(cmd):
+    """Like lazy.spawn(cmd), but started by spawn_server"""
+    return lazy.function(lambda qtile: spawn_server.spawn(cmd))
+
+
+class AlsaMixer(object):
+    """
+    Long-lived ALSA mixer handle (pyalsaaudio) shared by volume keys and
+    MixerVolume widget, instead of running amixer for every change.
+
+    Repeated volume changes within `delay` seconds are summed up and set at
+    once. Mute sets all of mute_channels to the same state. Listeners are
+    called with new volume (-1 if muted) on every mixer change event.
+    Without pyalsaaudio amixer is run through spawn_server.
+    """
+    def __init__(self, channel='Master', mute_channels=('Master', 'Speaker+LO'),
+                 delay=0.05):
+        self.channel = channel
+        self.mute_channels = mute_channels
+        self.delay = delay
+        self.mixers = {}
+        self.pending = 0
+        self.timer = None
+        self.listeners = []
+        self.watched = False
+
+    def mixer(self, name):
+        if alsaaudio is None:
+            return None
+        if name not in self.mixers:
+            try:
+                self.mixers[name] = alsaaudio.Mixer(name)
+            except alsaaudio.ALSAAudioError:
+                self.mixers[name] = None
+        return self.mixers[name]
+
+    def volume(self):
+        mixer = self.mixer(self.channel)
+        if mixer is None:
+            return None
+        try:
+            if any(mixer.getmute()):
+                return -1
+        except alsaaudio.ALSAAudioError:
+            # Channel has no mute switch
+            pass
+        return mixer.getvolume()[0]
+
+    def change(self, qtile, delta):
+        self.pending += delta
+        if self.timer is None:
+            self.timer = qtile.call_later(self.delay, self._apply)
+
+    def _apply(self):
+        self.timer = None
+        delta, self.pending = self.pending, 0
+        if not delta:
+            return
+        mixer = self.mixer(self.channel)
+        if mixer is None:
+            spawn_server.spawn(['amixer', '-q', 'sset', self.channel,
+                                '%d%%%s' % (abs(delta), '+' if delta > 0 else '-')])
+            return
+        volume = mixer.getvolume()[0]
+        mixer.setvolume(max(0, min(100, volume + delta)))
+        self.notify()
+
+    def toggle_mute(self, qtile=None):
+        master = self.mixer(self.channel)
+        if master is None:
+            for name in self.mute_channels:
+                spawn_server.spawn(['amixer', '-q', 'sset', name, 'toggle'])
+            return
+        # BUG: Unmute in Ubuntu works not so much good. Workaround: mute master,
+        # but unmute other channels also.
+        mute = not any(master.getmute())
+        for name in self.mute_channels:
+            mixer = self.mixer(name)
+            if mixer is not None:
+                try:
+                    mixer.setmute(mute)
+                except alsaaudio.ALSAAudioError:
+                    pass
+        self.notify()
+
+    def watch(self, qtile, listener):
+        """Call listener(volume) on mixer changes. False if not supported."""
+        mixer = self.mixer(self.channel)
+        if mixer is None or not hasattr(mixer, 'handleevents'):
+            return False
+        self.listeners.append(listener)
+        if not self.watched:
+            for fd, events in mixer.polldescriptors():
+                qtile._eventloop.add_reader(fd, self._handle_events)
+            self.watched = True
+        return True
+
+    def _handle_events(self):
+        self.mixer(self.channel).handleevents()
+        self.notify()
+
+    def notify(self):
+        volume = self.volume()
+        for listener in self.listeners:
+            listener(volume)
+
+
+alsa_mixer = AlsaMixer()
+
+
+def volume_change(delta):
+    return lazy.function(lambda qtile: alsa_mixer.change(qtile, delta))
+
+
+class KbddService(object):
+    """
+    One shared session bus connection to kbdd, used to switch layouts and
+    to receive layoutChanged signal once for all KbddLayout widgets.
+    Listeners are called with layout index in qtile event loop.
+    Without python-dbus or a session bus layouts are switched by dbus-send.
+    """
+    service = 'ru.gentoo.KbddService'
+    path = '/ru/gentoo/KbddService'
+    interface = 'ru.gentoo.kbdd'
+
+    def __init__(self):
+        self.bus = None
+        self.proxy = None
+        self.listeners = []
+        self.layout = None
+
+    def _connect(self):
+        if self.bus is None and dbus is not None:
+            try:
+                bus = dbus.SessionBus(mainloop=DBusGMainLoop())
+                # Don't introspect, it is a blocking call
+                self.proxy = bus.get_object(self.service, self.path,
+                                            introspect=False)
+            except dbus.DBusException as e:
+                logger.warning('cannot connect to kbdd: %s', e)
+            else:
+                self.bus = bus
+        return self.bus is not None
+
+    def set_layout(self, index):
+        if not self._connect():
+            spawn_server.spawn(['dbus-send', '--dest=' + self.service, self.path,
+                                self.interface + '.set_layout', 'uint32:%d' % index])
+            return
+        self.proxy.set_layout(dbus.UInt32(index), dbus_interface=self.interface,
+                              ignore_reply=True)
+
+    def subscribe(self, listener):
+        if not self._connect():
+            return False
+        if not self.listeners:
+            self.bus.add_signal_receiver(self._layout_changed,
+                                         dbus_interface=self.interface,
+                                         signal_name='layoutChanged')
+            # Ask for current layout, kbdd may be not running yet
+            self.proxy.getCurrentLayout(dbus_interface=self.interface,
+                                        reply_handler=self._layout_changed,
+                                        error_handler=lambda e: None)
+        self.listeners.append(listener)
+        if self.layout is not None:
+            listener(self.layout)
+        return True
+
+    def _layout_changed(self, index):
+        # Called from gobject thread
+        hook.qtile.call_soon_threadsafe(self._notify, int(index))
+
+    def _notify(self, index):
+        self.layout = index
+        for listener in self.listeners:
+            listener(index)
+
+
+kbdd = KbddService()
+
+
+class ResumeWatcher(object):
+    """
+    Calls listeners after the system resumes from suspend, so anything
+    showing wall clock time can resync. Timers of the event loop are paused
+    while suspended.
+
+    Resume is taken from logind PrepareForSleep signal. suspend() also calls
+    listeners a few times after suspend is requested, those calls land
+    right after resume (or are harmless if suspend didn't happen yet).
+    """
+    def __init__(self, delays=(3, 10, 30)):
+        self.delays = delays
+        self.listeners = []
+        self.bus = None
+
+    def watch(self):
+        if dbus is None or self.bus is not None:
+            return
+        try:
+            self.bus = dbus.SystemBus(mainloop=DBusGMainLoop())
+            self.bus.add_signal_receiver(self._prepare_for_sleep,
+                                         dbus_interface='org.freedesktop.login1.Manager',
+                                         signal_name='PrepareForSleep')
+        except dbus.DBusException as e:
+            logger.warning('cannot watch for resume: %s', e)
+
+    def _prepare_for_sleep(self, sleeping):
+        # Called from gobject thread
+        if not sleeping:
+            hook.qtile.call_soon_threadsafe(self.notify)
+
+    def notify(self):
+        for listener in self.listeners:
+            listener()
+
+    def suspend(self, qtile):
+        spawn_server.spawn("systemctl suspend")
+        for delay in self.delays:
+            qtile.call_later(delay, self.notify)
+
+
+resume_watcher = ResumeWatcher()
+
+
+def callable_name(func):
+    """Short readable name of hook callback or lazy.function argument"""
+    if isinstance(func, functools.partial):
+        return callable_name(func.func)
+    name = getattr(func, '__qualname__', None) or type(func).__qualname__
+    # find_or_run.<locals>.__inner -> find_or_run
+    return name.split('.<locals>')[0]
+
+
+class PerfStats(object):
+    """
+    Call counts and latency histograms of hook callbacks, commands run by
+    key bindings (lazy.function by function name) and bar widget
+    tick/update/draw. Costs two perf_counter() calls and a bisect per call.
+
+    Available as perf_stats, perf_dump and perf_reset commands.
+    """
+    # Upper bounds of histogram buckets, in milliseconds
+    buckets = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+    def __init__(self, dump_path):
+        self.dump_path = dump_path
+        self.stats = {}
+        self.names = {}
+        self.running = []
+
+    def record(self, name, seconds):
+        stat = self.stats.get(name)
+        if stat is None:
+            stat = self.stats[name] = [0, 0.0, 0.0,
+                                       array.array('L', [0] * (len(self.buckets) + 1))]
+        ms = seconds * 1000
+        stat[0] += 1
+        stat[1] += ms
+        if ms > stat[2]:
+            stat[2] = ms
+        stat[3][bisect.bisect_left(self.buckets, ms)] += 1
+
+    def call(self, name, func, *args, **kwargs):
+        # [name, start, reported by hook_watchdog]
+        entry = [name, time.perf_counter(), False]
+        self.running.append(entry)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.running.pop()
+            elapsed = time.perf_counter() - entry[1]
+            self.record(name, elapsed)
+            if entry[2]:
+                logger.warning('%s took %d ms', name, elapsed * 1000)
+
+    def wrap(self, name, func):
+        return functools.partial(self.call, name, func)
+
+    def fire(self, event, *args, **kwargs):
+        """hook.fire timing each subscriber"""
+        if event not in hook.subscribe.hooks:
+            return self.stock_fire(event, *args, **kwargs)
+        if event not in hook.SKIPLOG:
+            logger.info("Internal event: %s(%s, %s)", event, args, kwargs)
+        for func in hook.subscriptions.get(event, []):
+            name = self.names.get(func)
+            if name is None:
+                name = self.names[func] = 'hook %s %s' % (event, callable_name(func))
+            try:
+                self.call(name, func, *args, **kwargs)
+            except:  # noqa: E722
+                logger.exception("Error in hook %s", event)
+
+    def install_hooks(self):
+        """
+        Time hook subscribers. Done at config load, before qtile fires
+        any hook (startup_once, the client_new burst of the initial scan)
+        """
+        if hook.fire != self.fire:
+            self.stock_fire = hook.fire
+            hook.fire = self.fire
+
+    def install(self, qtile):
+        # Key bindings and mouse actions run commands through server.call
+        stock_call = qtile.server.call
+
+        def call(data):
+            name = data[1]
+            if name == 'function' and data[2]:
+                name = 'function ' + callable_name(data[2][0])
+            else:
+                name = 'command ' + name
+            return self.call(name, stock_call, data)
+        qtile.server.call = call
+
+        for screen in qtile.screens:
+            for gap in screen.gaps:
+                for w in getattr(gap, 'widgets', []):
+                    for method in ('tick', 'update', 'draw'):
+                        if hasattr(w, method):
+                            setattr(w, method, self.wrap(
+                                'widget %s.%d %s' % (w.name, screen.index, method),
+                                getattr(w, method)))
+
+    def report(self):
+        report = {}
+        labels = ['<=%gms' % b for b in self.buckets] + ['>%gms' % self.buckets[-1]]
+        for name, (count, total, longest, histogram) in self.stats.items():
+            report[name] = {
+                'count': count,
+                'total_ms': round(total, 3),
+                'mean_ms': round(total / count, 3),
+                'max_ms': round(longest, 3),
+                'histogram': dict((l, n) for l, n in zip(labels, histogram) if n),
+            }
+        return report
+
+    def dump(self, path=None):
+        path = path or self.dump_path
+        report = self.report()
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+        return path
+
+    def reset(self):
+        self.stats.clear()
+
+
+perf = PerfStats(home + '/.cache/qtile-perf.json')
+perf.install_hooks()
+
+
+class HookWatchdog(object):
+    """
+    Reports dispatches (hook callbacks, key commands, widget updates timed
+    by perf) holding the event loop longer than `threshold` seconds.
+
+    A thread checks every threshold / 2 what the loop is running. A blocked
+    dispatch is logged once with the stack of the loop thread at that
+    moment, and again with its total time when it finishes. At most `burst`
+    reports per `period` seconds are logged, the rest are only counted.
+    """
+    def __init__(self, perf, threshold=0.25, burst=5, period=60):
+        self.perf = perf
+        self.threshold = threshold
+        self.burst = burst
+        self.period = period
+        self.reports = []
+        self.suppressed = 0
+        self.loop_thread = None
+
+    def start(self):
+        """
+        Watch the calling thread, which must be the event loop one: config
+        is loaded in it, before startup_once is fired
+        """
+        if self.loop_thread is not None:
+            return
+        self.loop_thread = threading.get_ident()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.threshold / 2)
+            try:
+                entry = self.perf.running[0]
+            except IndexError:
+                continue
+            if entry[2] or time.perf_counter() - entry[1] < self.threshold:
+                continue
+            entry[2] = True
+            now = time.monotonic()
+            self.reports = [t for t in self.reports if t > now - self.period]
+            if len(self.reports) >= self.burst:
+                self.suppressed += 1
+                continue
+            self.reports.append(now)
+            self.report(entry)
+
+    def report(self, entry):
+        names = ' > '.join(e[0] for e in list(self.perf.running))
+        frame = sys._current_frames().get(self.loop_thread)
+        stack = ''.join(traceback.format_stack(frame)) if frame else ''
+        suppressed, self.suppressed = self.suppressed, 0
+        logger.warning('event loop blocked for %d ms by %s%s\n%s',
+                       (time.perf_counter() - entry[1]) * 1000, names,
+                       ' (%d more reports suppressed)' % suppressed if suppressed else '',
+                       stack)
+
+
+hook_watchdog = HookWatchdog(perf)
+hook_watchdog.start()
+
+
+def kbdd_layout(index):
+    return lazy.function(lambda qtile: kbdd.set_layout(index))
 
 
 def execute_once(process):
     if not is_running(process):
-        return subprocess.Popen(process.split())
+        spawn_server.spawn(process.split())
+
+
+class StartupTask(object):
+    """
+    One step of startup pipeline.
+
+    cmd is an argument list. Task is started when all tasks named in `after`
+    have finished. If `once` is set, it is a daemon: it is skipped when
+    a process matching `process` (or regex of command name) is already
+    running, and it is not waited for.
+    """
+    def __init__(self, name, cmd, after=(), once=False, process=None):
+        self.name = name
+        self.cmd = cmd
+        self.after = after
+        self.once = once
+        self.process = process or regex(os.path.basename(cmd[0]))
+
+
+class StartupPipeline(object):
+    """
+    Runs StartupTasks concurrently in background threads, respecting their
+    dependencies, and writes per-task timing report to report_path.
+    All "once" checks use one process snapshot taken before start.
+    """
+    def __init__(self, tasks, report_path=None):
+        self.tasks = tasks
+        self.report_path = report_path
+        self.done = {task.name: threading.Event() for task in tasks}
+        self.results = {}
+        self.snapshot = ()
+        self.started = None
+
+    def start(self):
+        process_table.refresh(force=True)
+        self.snapshot = tuple(process_table.cmdlines.values())
+        self.started = time.monotonic()
+        threads = [threading.Thread(target=self._run_task, args=(task, ),
+                                    name='startup-' + task.name, daemon=True)
+                   for task in self.tasks]
+        for thread in threads:
+            thread.start()
+        threading.Thread(target=self._report, args=(threads, ),
+                         name='startup-report', daemon=True).start()
+
+    def _run_task(self, task):
+        for name in task.after:
+            if name in self.done:
+                self.done[name].wait()
+        start = time.monotonic()
+        try:
+            if task.once and any(re.search(task.process, p) for p in self.snapshot):
+                status = 'already running'
+            elif task.once:
+                spawn_server.spawn(task.cmd)
+                status = 'started'
+            else:
+                status = 'exit %d' % subprocess.call(task.cmd)
+        except OSError as e:
+            status = 'error: %s' % e
+            logger.warning('startup task %s failed: %s', task.name, e)
+        finally:
+            self.results[task.name] = (start - self.started,
+                                       time.monotonic() - start, status)
+            self.done[task.name].set()
+
+    def _report(self, threads):
+        for thread in threads:
+            thread.join()
+        total = time.monotonic() - self.started
+        lines = ['%-16s %8.3f %8.3f  %s' % ((task.name, ) + self.results[task.name])
+                 for task in self.tasks]
+        lines.append('%-16s %8s %8.3f' % ('total', '', total))
+        logger.info('startup pipeline finished in %.3f s', total)
+        if self.report_path:
+            try:
+                with open(self.report_path, 'w') as f:
+                    f.write('%-16s %8s %8s  %s\n' % ('task', 'start', 'time', 'status'))
+                    f.write('\n'.join(lines))
+                    f.write('\n')
+            except OSError as e:
+                logger.warning('cannot write startup report: %s', e)
 
 
 def regex(name):
@@ -299,53 +1867,296 @@ def regex(name):
 #### MAIN ####
 
 # Init monitors
-def xrandr_set_screens():
-    xrandr_state = check_output(['xrandr'])
-
-    if b'HDMI-2 connected' in xrandr_state \
-            and b'HDMI-3 connected' in xrandr_state:
-        # Two external monitors
-        xrandr_setting = [
-            'xrandr',
-            '--output', 'VGA-1','--off',
-            '--output', 'LVDS-1','--off',
-            '--output', 'HDMI-2', '--mode','1280x1024','--pos','0x0','--rotate','normal',
-            '--output', 'HDMI-3', '--primary','--mode','1920x1080','--pos','1280x140','--rotate','normal',
-            '--output', 'HDMI-1','--off',
-            '--output', 'DP-3', '--off',
-            '--output', 'DP-2', '--off',
-            '--output', 'DP-1', '--off',
-            ]
-    elif b'HDMI-3 connected' in xrandr_state:
-        # One external monitor and built-in monitor
-        xrandr_setting = [
-            'xrandr',
-            '--output', 'VGA-1','--off',
-            '--output', 'LVDS-1','--mode','1366x768','--pos','1920x0','--rotate','normal',
-            '--output', 'HDMI-3', '--primary','--mode','1920x1080','--pos','0x0','--rotate','normal',
-            '--output', 'HDMI-2','--off',
-            '--output', 'HDMI-1','--off',
-            '--output', 'DP-3', '--off',
-            '--output', 'DP-2', '--off',
-            '--output', 'DP-1', '--off',
-            ]
-    else:
-        # Built-in monitor only
-        xrandr_setting = [
-            'xrandr',
-            '--output', 'VGA-1','--off',
-            '--output', 'LVDS-1','--mode','1366x768','--pos','0x0','--rotate','normal',
-            '--output', 'HDMI-3','--off',
-            '--output', 'HDMI-2','--off',
-            '--output', 'HDMI-1','--off',
-            '--output', 'DP-3', '--off',
-            '--output', 'DP-2', '--off',
-            '--output', 'DP-1', '--off',
-        ]
+class MonitorProfiles(object):
+    """
+    Monitor layouts selected by the set of connected outputs.
+
+    profiles is a list of (required outputs, layout) pairs, first profile
+    whose required outputs are all connected wins. Layout maps output name
+    to dict(mode=..., pos=..., primary=...), outputs missing in layout
+    are turned off.
+
+    Outputs are read through RandR on our own X connection. Connected
+    outputs and their EDIDs make a fingerprint, resolved layouts are cached
+    by it in cache_path (so the cache survives restarts, and is dropped if
+    profiles change), and xrandr is run only if current configuration
+    differs. apply() blocks, it is run in qtile's executor.
+    """
+    def __init__(self, profiles, cache_path=None):
+        self.profiles = profiles
+        self.cache_path = cache_path
+        self.layouts = None
+        self.profiles_hash = hashlib.sha1(json.dumps(
+            [(sorted(required), layout) for required, layout in profiles],
+            sort_keys=True).encode()).hexdigest()
+
+    def load_cache(self):
+        self.layouts = {}
+        if self.cache_path is None:
+            return
+        try:
+            with open(self.cache_path) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return
+        if cache.get('profiles') == self.profiles_hash:
+            self.layouts = cache.get('layouts', {})
 
-    call(xrandr_setting)
- 
-xrandr_set_screens()
+    def save_cache(self):
+        if self.cache_path is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            with open(self.cache_path + '.tmp', 'w') as f:
+                json.dump(dict(profiles=self.profiles_hash, layouts=self.layouts), f)
+            os.replace(self.cache_path + '.tmp', self.cache_path)
+        except OSError:
+            logger.exception('cannot write %s', self.cache_path)
+
+    def query(self):
+        """Return {output name: state} of all outputs known to RandR"""
+        conn = xcffib.connect()
+        try:
+            randr = conn(xcffib.randr.key)
+            root = conn.get_setup().roots[conn.pref_screen].root
+            res = randr.GetScreenResourcesCurrent(root).reply()
+            modes = {m.id: (m.width, m.height) for m in res.modes}
+            primary = randr.GetOutputPrimary(root).reply().output
+            edid_atom = conn.core.InternAtom(False, len('EDID'), 'EDID').reply().atom
+            # Send all requests before waiting for the replies
+            cookies = [(o, randr.GetOutputInfo(o, res.config_timestamp))
+                       for o in res.outputs]
+            outputs = {}
+            for output, cookie in cookies:
+                info = cookie.reply()
+                state = dict(connected=info.connection == xcffib.randr.Connection.Connected,
+                             edid=b'', mode=None, pos=None, primary=output == primary)
+                if state['connected']:
+                    state['edid'] = bytes(randr.GetOutputProperty(
+                        output, edid_atom, xcffib.xproto.GetPropertyType.Any,
+                        0, 128, False, False).reply().data)
+                if info.crtc:
+                    crtc = randr.GetCrtcInfo(info.crtc, res.config_timestamp).reply()
+                    if crtc.mode in modes:
+                        state['mode'] = '%dx%d' % modes[crtc.mode]
+                        state['pos'] = '%dx%d' % (crtc.x, crtc.y)
+                outputs[info.name.to_string()] = state
+        finally:
+            conn.disconnect()
+        return outputs
+
+    def query_xrandr(self):
+        """Fallback if RandR can't be queried directly: only connected state"""
+        outputs = {}
+        for line in check_output(['xrandr']).decode().splitlines():
+            words = line.split()
+            if len(words) > 1 and words[1] in ('connected', 'disconnected'):
+                outputs[words[0]] = dict(connected=words[1] == 'connected',
+                                         edid=b'', mode=None, pos=None, primary=False)
+        return outputs
+
+    def fingerprint(self, outputs):
+        return ' '.join(sorted('%s:%s' % (name, hashlib.sha1(state['edid']).hexdigest())
+                               for name, state in outputs.items() if state['connected']))
+
+    def layout(self, outputs):
+        if self.layouts is None:
+            self.load_cache()
+        fingerprint = self.fingerprint(outputs)
+        if fingerprint not in self.layouts:
+            connected = {name for name, state in outputs.items() if state['connected']}
+            self.layouts[fingerprint] = next(
+                (layout for required, layout in self.profiles if required <= connected), {})
+            self.save_cache()
+        return self.layouts[fingerprint]
+
+    def is_applied(self, layout, outputs):
+        for name, state in outputs.items():
+            want = layout.get(name)
+            if want is None:
+                if state['mode'] is not None:
+                    return False
+            elif state['mode'] != want['mode'] or state['pos'] != want['pos'] \
+                    or (want.get('primary') and not state['primary']):
+                return False
+        return True
+
+    def xrandr_args(self, layout, outputs):
+        args = ['xrandr']
+        # Free CRTCs first, then enable outputs
+        for name in sorted(outputs):
+            if name not in layout:
+                args += ['--output', name, '--off']
+        for name, want in sorted(layout.items()):
+            args += ['--output', name, '--mode', want['mode'], '--pos', want['pos'],
+                     '--rotate', 'normal']
+            if want.get('primary'):
+                args.append('--primary')
+        return args
+
+    def apply(self):
+        """Configure monitors for connected outputs. Return True if changed."""
+        try:
+            outputs = self.query()
+        except Exception:
+            logger.exception('cannot query RandR, falling back to xrandr')
+            outputs = self.query_xrandr()
+        layout = self.layout(outputs)
+        if not layout or self.is_applied(layout, outputs):
+            return False
+        call(self.xrandr_args(layout, outputs))
+        return True
+
+
+monitor_profiles = MonitorProfiles([
+    # Two external monitors
+    ({'HDMI-2', 'HDMI-3'}, {
+        'HDMI-2': dict(mode='1280x1024', pos='0x0'),
+        'HDMI-3': dict(mode='1920x1080', pos='1280x140', primary=True),
+    }),
+    # One external monitor and built-in monitor
+    ({'HDMI-3'}, {
+        'LVDS-1': dict(mode='1366x768', pos='1920x0'),
+        'HDMI-3': dict(mode='1920x1080', pos='0x0', primary=True),
+    }),
+    # Built-in monitor only
+    (set(), {
+        'LVDS-1': dict(mode='1366x768', pos='0x0'),
+    }),
+], home + '/.cache/qtile-monitors.json')
+
+
+def resize_drawer(drawer, width, height):
+    """Replace drawer's pixmap and cairo surface with ones of new size"""
+    conn = drawer.qtile.conn
+    conn.conn.core.FreePixmap(drawer.pixmap)
+    drawer.width, drawer.height = width, height
+    drawer.pixmap = conn.conn.generate_id()
+    conn.conn.core.CreatePixmap(conn.default_screen.root_depth, drawer.pixmap,
+                                drawer.wid, width, height)
+    drawer.surface = cairocffi.XCBSurface(conn.conn, drawer.pixmap,
+                                          drawer.find_root_visual(), width, height)
+    drawer.ctx = drawer.new_ctx()
+
+
+class ScreenChangeHandler(object):
+    """
+    Applies monitor changes in place instead of restarting qtile.
+
+    Burst of RandR events (docking produces several) is coalesced: screens
+    are reconfigured once, `settle` seconds after the last event. Existing
+    screens and their bars are moved/resized, screens for new monitors are
+    configured with a free group, screens of removed monitors are hidden.
+    """
+    def __init__(self, settle=0.5):
+        self.settle = settle
+        self.timer = None
+
+    def install(self, qtile):
+        # qtile 0.13 resizes current screen to the whole root window on every
+        # root ConfigureNotify; geometry is handled by us instead.
+        def handle_ConfigureNotify(e):
+            if e.window == qtile.root.wid:
+                self.schedule(qtile)
+        qtile.handle_ConfigureNotify = handle_ConfigureNotify
+
+    def schedule(self, qtile):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = qtile.call_later(self.settle, self.reconfigure, qtile)
+
+    def reconfigure(self, qtile):
+        self.timer = None
+        future = qtile.run_in_executor(monitor_profiles.apply)
+        future.add_done_callback(lambda f: self.profile_applied(qtile, f))
+
+    def profile_applied(self, qtile, future):
+        error = future.exception()
+        if error is not None:
+            logger.error('cannot apply monitor profile', exc_info=error)
+        # Monitors changed anyway, follow what X reports
+        self.apply_geometry(qtile)
+
+    def query_geometry(self, qtile):
+        if hasattr(qtile.conn, 'xinerama'):
+            rects = [(s.x_org, s.y_org, s.width, s.height)
+                     for s in qtile.conn.xinerama.query_screens()]
+        else:
+            rects = [(c['x'], c['y'], c['width'], c['height'])
+                     for c in qtile.conn.randr.query_crtcs(qtile.root.wid)
+                     if c['width'] and c['height']]
+        # Mirrored outputs share one screen, same as qtile does on start
+        sizes = {}
+        for x, y, w, h in rects:
+            width, height = sizes.get((x, y), (0, 0))
+            sizes[(x, y)] = (max(w, width), max(h, height))
+        return [(x, y) + sizes[(x, y)] for x, y, _, _ in rects
+                if sizes.pop((x, y), None)]
+
+    def apply_geometry(self, qtile):
+        geometry = self.query_geometry(qtile)
+        if not geometry:
+            return
+        for screen in qtile.screens[len(geometry):]:
+            self.remove_screen(screen)
+        del qtile.screens[len(geometry):]
+        for index, (x, y, width, height) in enumerate(geometry):
+            if index < len(qtile.screens):
+                screen = qtile.screens[index]
+                if (screen.x, screen.y, screen.width, screen.height) != (x, y, width, height):
+                    self.move_screen(qtile, screen, x, y, width, height)
+            else:
+                self.add_screen(qtile, index, x, y, width, height)
+        if qtile.currentScreen not in qtile.screens:
+            qtile.currentScreen = qtile.screens[0]
+        hook.fire("setgroup")
+        qtile.conn.flush()
+
+    def move_screen(self, qtile, screen, x, y, width, height):
+        screen.x, screen.y, screen.width, screen.height = x, y, width, height
+        for gap in screen.gaps:
+            bar.Gap._configure(gap, qtile, screen)
+            if not hasattr(gap, 'window'):
+                continue
+            if (gap.drawer.width, gap.drawer.height) != (gap.width, gap.height):
+                drawers = [gap.drawer] + [w.drawer for w in gap.widgets]
+                if hasattr(gap, 'backing'):
+                    drawers.append(gap.backing)
+                for drawer in drawers:
+                    resize_drawer(drawer, gap.width, gap.height)
+            gap.window.place(gap.x, gap.y, gap.width, gap.height, 0, None)
+            gap.window.unhide()
+            gap.draw()
+        if screen.group:
+            screen.group.layoutAll()
+
+    def add_screen(self, qtile, index, x, y, width, height):
+        if index < len(qtile.config.screens):
+            screen = qtile.config.screens[index]
+        else:
+            screen = Screen()
+        group = next((g for g in qtile.groups if g.screen is None), None)
+        if screen.qtile is None:
+            screen._configure(qtile, index, x, y, width, height, group)
+        else:
+            # Screen of a monitor which was connected before, reuse its bars
+            screen.index = index
+            self.move_screen(qtile, screen, x, y, width, height)
+            if group:
+                screen.group = None
+                screen.setGroup(group)
+        qtile.screens.append(screen)
+
+    def remove_screen(self, screen):
+        for gap in screen.gaps:
+            if hasattr(gap, 'window'):
+                gap.window.hide()
+        # screen.group is kept, so widgets of hidden bars can still draw
+        if screen.group and screen.group.screen is screen:
+            screen.group._setScreen(None)
+
+
+screen_change_handler = ScreenChangeHandler()
 
 group_names = [
         "1:term",
@@ -456,55 +2267,57 @@ keys = [
     # Switch groups on 2nd monitor
     Key([mod], "F5", lazy.function(group_to_screen_by_index(5))),
 
-    #Key([], "F12", lazy.function(to_urgent)),
+    Key([mod], "F12", lazy.function(to_urgent)),
+    Key([mod, "shift"], "F12", lazy.function(cycle_urgent)),
 
     # Keyboard layout direct selection
-    Key([alt], "l", lazy.spawn("dbus-send --dest=ru.gentoo.KbddService /ru/gentoo/KbddService ru.gentoo.kbdd.set_layout uint32:0")),
-    Key([alt], "semicolon", lazy.spawn("dbus-send --dest=ru.gentoo.KbddService /ru/gentoo/KbddService ru.gentoo.kbdd.set_layout uint32:1")),
-    Key([alt], "quoteright", lazy.spawn("dbus-send --dest=ru.gentoo.KbddService /ru/gentoo/KbddService ru.gentoo.kbdd.set_layout uint32:2")),
-    #Key([mod, "shift"], "u", lazy.spawn("dbus-send --dest=ru.gentoo.KbddService /ru/gentoo/KbddService ru.gentoo.kbdd.set_layout uint32:2")),
+    Key([alt], "l", kbdd_layout(0)),
+    Key([alt], "semicolon", kbdd_layout(1)),
+    Key([alt], "quoteright", kbdd_layout(2)),
+    #Key([mod, "shift"], "u", kbdd_layout(2)),
 
     # Sound
-    Key([], "XF86AudioRaiseVolume", lazy.spawn("amixer sset Master 5%+")),
-    Key([mod], "KP_Add", lazy.spawn("amixer sset Master 5%+")),
-    Key([], "XF86AudioLowerVolume", lazy.spawn("amixer sset Master 5%-")),
-    Key([mod], "KP_Subtract", lazy.spawn("amixer sset Master 5%-")),
-    # BUG: Unmute in Ubuntu works not so much good. Workaround: mute master, but unmute other channels also.
-    Key([], "XF86AudioMute", lazy.spawn("amixer sset Master toggle"), lazy.spawn("amixer sset Speaker+LO toggle")),
-    Key([mod], "KP_Multiply", lazy.spawn("amixer sset Master toggle"), lazy.spawn("amixer sset Speaker+LO toggle")),
+    Key([], "XF86AudioRaiseVolume", volume_change(5)),
+    Key([mod], "KP_Add", volume_change(5)),
+    Key([], "XF86AudioLowerVolume", volume_change(-5)),
+    Key([mod], "KP_Subtract", volume_change(-5)),
+    # Mutes/unmutes Master and Speaker+LO together, see AlsaMixer.toggle_mute
+    Key([], "XF86AudioMute", lazy.function(alsa_mixer.toggle_mute)),
+    Key([mod], "KP_Multiply", lazy.function(alsa_mixer.toggle_mute)),
 
     # Launch applications
-    Key([mod], "Return", lazy.spawn(terminal)),
+    Key([mod], "Return", spawn(terminal)),
     Key([mod], "w", lazy.function(find_or_run(browser, (browser_wm_class,), group=group_names[1]))),
     #Key([mod], "q", lazy.function(find_or_run(browser_2, (browser_2_wm_class, ), group=group_names[2]))),
-    Key([mod], "q", lazy.spawn("chromium-browser --profile-directory=ProfileDev")),
-    Key([mod], "f", lazy.spawn(file_manager)),
+    Key([mod], "q", spawn("chromium-browser --profile-directory=ProfileDev")),
+    Key([mod], "f", spawn(file_manager)),
     Key([mod], "v", lazy.function(find_or_run("viber"))),
     Key([mod], "s", lazy.function(find_or_run("skypeforlinux"))),
-    Key([mod], "d", lazy.spawn("goldendict")),
-    Key([mod], "e", lazy.spawn("gedit")),
+    Key([mod], "d", spawn("goldendict")),
+    Key([mod], "e", spawn("gedit")),
     Key([mod], "c", lazy.function(find_or_run("gnome-calculator"))),
     Key([mod], "o", lazy.function(find_or_run("gnome-control-center"))),
-    Key([mod], "i", lazy.spawn("libreoffice --writer")),
-    Key([mod, "control"], "F1", lazy.spawn("qtile-autostart-dev")),
+    Key([mod], "i", spawn("libreoffice --writer")),
+    Key([mod, "control"], "F1", spawn("qtile-autostart-dev")),
 
     # Screenshots
-    Key(["shift"], "Print", lazy.spawn("gnome-screenshot -ia")),
-    #Key(["shift"], "Print", lazy.spawn("gnome-screenshot -a -f " + home + "/Pictures/screenshot.png --display=:0")),
-    Key([], "Print", lazy.spawn("scrot " + home + "/Pictures/screenshot_%Y_%m_%d_%H_%M_%S.png")),
-    Key(["control"], "Print", lazy.spawn("scrot -u " + home + "/Pictures/screenshot_%Y_%m_%d_%H_%M_%S.png")),
+    Key(["shift"], "Print", spawn("gnome-screenshot -ia")),
+    #Key(["shift"], "Print", spawn("gnome-screenshot -a -f " + home + "/Pictures/screenshot.png --display=:0")),
+    Key([], "Print", spawn("scrot " + home + "/Pictures/screenshot_%Y_%m_%d_%H_%M_%S.png")),
+    Key(["control"], "Print", spawn("scrot -u " + home + "/Pictures/screenshot_%Y_%m_%d_%H_%M_%S.png")),
 
     Key([mod, "control"], "r", lazy.restart()),
     Key([mod, "control"], "q", lazy.shutdown()),
     #Key([mod], "t", lazy.findwindow()),
     #Key([mod], "r", lazy.spawncmd()),
-    Key([mod], "r", lazy.spawn(dmenu)),
-    Key([mod], "a", lazy.spawn(dmenu_windows)),
+    Key([mod], "r", spawn(dmenu)),
+    #Key([mod], "a", spawn(dmenu_windows)),
+    Key([mod], "a", lazy.function(window_switcher.show)),
     
     # suspend
-    Key([mod, "control"], "z", lazy.spawn("systemctl suspend")),
+    Key([mod, "control"], "z", lazy.function(resume_watcher.suspend)),
     # power off
-    Key([mod, "control"], "x", lazy.spawn("shutdown -h now")),
+    Key([mod, "control"], "x", spawn("shutdown -h now")),
 ]
 
 groups = [
@@ -612,6 +2425,786 @@ layouts = [
     layout.Floating(**layout_theme)
 ]
 
+#### CUSTOM WIDGETS ####
+
+class ScheduledCall(object):
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+
+    def cancel(self):
+        self.func = None
+
+
+class WidgetScheduler(object):
+    """
+    Shared timer for bar widgets.
+
+    Deadlines are rounded up to multiples of `quantum` seconds, so widgets
+    of both bars with different intervals wake up the event loop together.
+    Widget draws requested during a tick are done once, at the end of it.
+    """
+    def __init__(self, quantum=0.5):
+        self.quantum = quantum
+        self.jobs = {}
+        self.timer = None
+        self.next_tick = None
+        self.in_tick = False
+        self.damaged = {}
+
+    def call_later(self, seconds, func, *args):
+        tick = math.ceil((time.monotonic() + seconds) / self.quantum) * self.quantum
+        job = ScheduledCall(func, args)
+        self.jobs.setdefault(tick, []).append(job)
+        if self.next_tick is None or tick < self.next_tick:
+            self._schedule(tick)
+        return job
+
+    def _schedule(self, tick):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.next_tick = tick
+        self.timer = hook.qtile.call_later(max(0, tick - time.monotonic()), self._run)
+
+    def _run(self):
+        self.timer = self.next_tick = None
+        now = time.monotonic()
+        self.in_tick = True
+        # One failing job or draw must not stop the others, or the tick
+        # from being rescheduled
+        for tick in sorted(t for t in self.jobs if t <= now + 0.001):
+            for job in self.jobs.pop(tick):
+                func, job.func = job.func, None
+                if func is None:
+                    continue
+                try:
+                    func(*job.args)
+                except Exception:
+                    logger.exception('error in scheduled %s', callable_name(func))
+        self.in_tick = False
+        damaged = list(self.damaged)
+        self.damaged.clear()
+        for w in damaged:
+            try:
+                w.draw()
+            except Exception:
+                logger.exception('error drawing widget %s', w.name)
+        if self.jobs:
+            self._schedule(min(self.jobs))
+
+    def damage(self, widget):
+        self.damaged[widget] = None
+
+    def forget(self, widget):
+        self.damaged.pop(widget, None)
+
+
+widget_scheduler = WidgetScheduler()
+
+
+class Scheduled(object):
+    """Widget mixin moving widget timers and draws to widget_scheduler"""
+    def timeout_add(self, seconds, method, method_args=()):
+        # Keep pending calls, to cancel them in finalize()
+        calls = [c for c in getattr(self, 'scheduled_calls', ()) if c.func is not None]
+        calls.append(widget_scheduler.call_later(seconds, self._wrapper, method,
+                                                 *method_args))
+        self.scheduled_calls = calls
+        return calls[-1]
+
+    def draw(self):
+        if widget_scheduler.in_tick:
+            widget_scheduler.damage(self)
+        else:
+            super().draw()
+
+    def finalize(self):
+        for job in getattr(self, 'scheduled_calls', ()):
+            job.cancel()
+        self.scheduled_calls = []
+        widget_scheduler.forget(self)
+        super().finalize()
+
+
+class AlignedClock(widget.Clock):
+    """
+    Clock sleeping exactly until its text can change: the smallest unit
+    used in format (second, minute, hour, day) is found, and the next tick
+    is set to the next boundary of it. Text is redrawn only if changed.
+    Resyncs after resume from suspend.
+    """
+    steps = [(1, 'sSTcXr+'), (60, 'MR'), (3600, 'HIklpP')]
+
+    def __init__(self, **config):
+        widget.Clock.__init__(self, **config)
+        self.step = 86400
+        self.timer = None
+
+    def timer_setup(self):
+        directives = set(re.findall(r'%[-_0^#]?[EO]?([a-zA-Z+%])', self.format))
+        self.step = next((step for step, chars in self.steps
+                          if directives & set(chars)), 86400)
+        if self.resync not in resume_watcher.listeners:
+            resume_watcher.listeners.append(self.resync)
+        widget.Clock.timer_setup(self)
+
+    def tick(self):
+        self.update(self.poll())
+        now = time.time() + time.localtime().tm_gmtoff
+        return self.step - now % self.step + 0.01
+
+    def timeout_add(self, seconds, method, method_args=()):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = widget.Clock.timeout_add(self, seconds, method, method_args)
+        return self.timer
+
+    def resync(self):
+        # Ticks now, pending tick is cancelled by timeout_add
+        widget.Clock.timer_setup(self)
+
+
+class RingBuffer(object):
+    """Fixed size history of floats in an array, newest first when iterated"""
+    def __init__(self, size):
+        self.data = array.array('d', bytes(8 * size))
+        self.size = size
+        self.pos = 0
+
+    def push(self, value):
+        self.pos = (self.pos - 1) % self.size
+        self.data[self.pos] = value
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        return self.data[(self.pos + index) % self.size]
+
+    def __iter__(self):
+        return itertools.chain(self.data[self.pos:], self.data[:self.pos])
+
+    def __reversed__(self):
+        return itertools.chain(reversed(self.data[:self.pos]),
+                               reversed(self.data[self.pos:]))
+
+    def max(self):
+        return max(self.data)
+
+
+class SystemSampler(object):
+    """
+    Samples /proc/stat and hwmon/thermal sysfs temperatures in one pass on
+    widget_scheduler, for all widgets subscribed.
+
+    Files are opened once and re-read with pread. Metrics are 'cpu',
+    'cpu0', 'cpu1'... (usage in percents) and 'temp:<label>' (celsius),
+    labels are the ones `sensors` shows (temp*_label, else temp1...) or
+    thermal zone type. Every metric subscribed keeps history in RingBuffers.
+    Subscribers with the same interval are sampled in the same pass.
+    """
+    def __init__(self, interval=2):
+        self.interval = interval
+        self.stat = None
+        self.stat_size = 256 + 128 * (os.cpu_count() or 1)
+        # interval -> {cpu name: (busy, total)}
+        self.cpu_prev = {}
+        self.sensors = None
+        self.temps = {}
+        # interval -> {metric: {size: RingBuffer}}
+        self.buffers = {}
+        # interval -> {metric: [(listener, RingBuffer)]}
+        self.listeners = {}
+
+    def subscribe(self, metric, listener, size=100, interval=None):
+        """
+        Call listener(buffer) after each sample of metric, every `interval`
+        seconds (default self.interval); buffer is RingBuffer of `size`
+        last values
+        """
+        interval = interval or self.interval
+        buffers = self.buffers.setdefault(interval, {}).setdefault(metric, {})
+        if size not in buffers:
+            buffers[size] = RingBuffer(size)
+        start = interval not in self.listeners
+        self.listeners.setdefault(interval, {}).setdefault(metric, []).append(
+            (listener, buffers[size]))
+        if start:
+            self.sample(interval)
+        return buffers[size]
+
+    def open_sensors(self):
+        self.sensors = {}
+        for path in sorted(glob.glob('/sys/class/hwmon/hwmon*/temp*_input')):
+            label = os.path.basename(path)[:-len('_input')]
+            try:
+                with open(path[:-len('input')] + 'label') as f:
+                    label = f.read().strip()
+            except OSError:
+                pass
+            self._open_sensor(label, path)
+        for path in sorted(glob.glob('/sys/class/thermal/thermal_zone*/temp')):
+            try:
+                with open(os.path.join(os.path.dirname(path), 'type')) as f:
+                    label = f.read().strip()
+            except OSError:
+                continue
+            self._open_sensor(label, path)
+
+    def _open_sensor(self, label, path):
+        if label in self.sensors:
+            return
+        try:
+            self.sensors[label] = os.open(path, os.O_RDONLY)
+        except OSError:
+            pass
+
+    def read_temperatures(self):
+        if self.sensors is None:
+            self.open_sensors()
+        temps = {}
+        for label, fd in self.sensors.items():
+            try:
+                temps[label] = int(os.pread(fd, 32, 0)) / 1000.0
+            except (OSError, ValueError):
+                pass
+        self.temps = temps
+        return temps
+
+    def read_stat(self):
+        """Complete cpu lines of /proc/stat, growing the read size as needed"""
+        if self.stat is None:
+            self.stat = os.open('/proc/stat', os.O_RDONLY)
+        while True:
+            data = os.pread(self.stat, self.stat_size, 0)
+            if len(data) < self.stat_size:
+                return data
+            # Cut the partial last line, done if a line after cpu ones is in
+            data = data[:data.rfind(b'\n')]
+            if not data.rsplit(b'\n', 1)[-1].startswith(b'cpu'):
+                return data
+            self.stat_size *= 2
+
+    def read_cpu(self, interval):
+        cpu_prev = self.cpu_prev.setdefault(interval, {})
+        usage = {}
+        for line in self.read_stat().split(b'\n'):
+            if not line.startswith(b'cpu'):
+                break
+            name, user, nice, sys_, idle = line.split(None, 5)[:5]
+            busy = int(user) + int(nice) + int(sys_)
+            total = busy + int(idle)
+            name = name.decode()
+            prev = cpu_prev.get(name)
+            cpu_prev[name] = busy, total
+            if prev is not None and total != prev[1]:
+                usage[name] = (busy - prev[0]) * 100.0 / (total - prev[1])
+        return usage
+
+    def sample(self, interval):
+        values = {}
+        metrics = self.listeners[interval]
+        try:
+            if any(not m.startswith('temp:') for m in metrics):
+                values.update(self.read_cpu(interval))
+            if any(m.startswith('temp:') for m in metrics):
+                for label, temp in self.read_temperatures().items():
+                    values['temp:' + label] = temp
+        finally:
+            widget_scheduler.call_later(interval, self.sample, interval)
+        for metric, listeners in metrics.items():
+            if metric not in values:
+                continue
+            for buf in self.buffers[interval][metric].values():
+                buf.push(values[metric])
+            for listener, buf in listeners:
+                listener(buf)
+
+
+# CPU graph and thermal sensor sample at its interval, in one pass
+system_sampler = SystemSampler(interval=3)
+
+
+class SampledCPUGraph(Scheduled, widget.CPUGraph):
+    """CPUGraph fed by system_sampler every `frequency` seconds"""
+    def _getvalues(self):
+        return (0, 0, 0, 0)
+
+    def timer_setup(self):
+        metric = 'cpu' if self.core == 'all' else 'cpu%s' % self.core
+        self.values = system_sampler.subscribe(metric, self.on_sample,
+                                               self.samples, self.frequency)
+
+    def on_sample(self, values):
+        if not self.fixed_upper_bound:
+            self.maxvalue = values.max()
+        self.draw()
+
+
+class SampledThermalSensor(Scheduled, widget.ThermalSensor):
+    """
+    ThermalSensor reading sysfs through system_sampler, not `sensors`.
+    Sensors are not in the order `sensors` prints them, so set tag_sensor;
+    if it is not found, the first sensor is shown.
+    """
+    def get_temp_sensors(self):
+        temps = system_sampler.temps or system_sampler.read_temperatures()
+        if not self.metric:
+            return dict((label, ('%.1f' % (t * 1.8 + 32), u'\xb0F'))
+                        for label, t in temps.items())
+        return dict((label, ('%.1f' % t, u'\xb0C'))
+                    for label, t in temps.items())
+
+    def timer_setup(self):
+        temps = system_sampler.temps or system_sampler.read_temperatures()
+        if self.tag_sensor not in temps:
+            fallback = next(iter(temps), None)
+            logger.warning('temperature sensor %r not found, showing %r',
+                           self.tag_sensor, fallback)
+            self.tag_sensor = fallback
+        if self.tag_sensor is None:
+            self.update('N/A')
+            return
+        self.update(self.poll())
+        system_sampler.subscribe('temp:%s' % self.tag_sensor, self.on_sample,
+                                 interval=self.update_interval)
+
+    def on_sample(self, values):
+        self.update(self.poll())
+
+
+class DiskUsage(object):
+    """
+    statvfs of all partitions subscribed, sampled together every `interval`
+    seconds in a background thread.
+
+    Every mount gets `timeout` seconds, a mount whose statvfs doesn't return
+    in time (hung NFS) is skipped, and not asked again until that call
+    returns. Listeners are called in the event loop, only when the values
+    they show, rounded to their unit, change.
+    """
+    def __init__(self, interval=60, timeout=2):
+        self.interval = interval
+        self.timeout = timeout
+        self.listeners = {}
+        self.pending = {}
+        self.thread = None
+        self.wake = threading.Event()
+
+    def subscribe(self, partition, listener, unit):
+        """Call listener(size, free, user_free) in `unit`s when changed"""
+        self.listeners.setdefault(partition, []).append([listener, unit, None])
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            # Start after all widgets of the bars subscribed
+            hook.qtile.call_soon(self.thread.start)
+        else:
+            self.wake.set()
+
+    @staticmethod
+    def _statvfs(partition, future):
+        try:
+            future.set_result(os.statvfs(partition))
+        except OSError as e:
+            future.set_exception(e)
+
+    def _run(self):
+        while True:
+            self.wake.clear()
+            futures = {}
+            hung = set(self.pending)
+            for partition in list(self.listeners):
+                future = self.pending.pop(partition, None)
+                if future is None:
+                    # Daemon thread, a hung mount must not block exit
+                    future = concurrent.futures.Future()
+                    threading.Thread(target=self._statvfs, daemon=True,
+                                     args=(partition, future)).start()
+                futures[partition] = future
+            deadline = time.monotonic() + self.timeout
+            results = {}
+            for partition, future in futures.items():
+                try:
+                    results[partition] = future.result(
+                        max(0, deadline - time.monotonic()))
+                except concurrent.futures.TimeoutError:
+                    if partition not in hung:
+                        logger.warning('statvfs of %s timed out', partition)
+                    self.pending[partition] = future
+                except OSError as e:
+                    logger.warning('statvfs of %s failed: %s', partition, e)
+            if results:
+                hook.qtile.call_soon_threadsafe(self._notify, results)
+            self.wake.wait(self.interval)
+
+    def _notify(self, results):
+        for partition, st in results.items():
+            for entry in self.listeners[partition]:
+                listener, unit, last = entry
+                values = (st.f_frsize * st.f_blocks // unit,
+                          st.f_frsize * st.f_bfree // unit,
+                          st.f_frsize * st.f_bavail // unit)
+                if values != last:
+                    entry[2] = values
+                    listener(*values)
+
+
+disk_usage = DiskUsage()
+
+
+class SharedDF(widget.DF):
+    """DF updated by disk_usage, so statvfs never blocks the event loop"""
+    usage = None
+
+    def timer_setup(self):
+        disk_usage.subscribe(self.partition, self.on_usage, self.calc)
+
+    def on_usage(self, size, free, user_free):
+        self.usage = size, free, user_free
+        self.update(self.poll())
+
+    def poll(self):
+        if self.usage is None:
+            return ""
+        size, free, self.user_free = self.usage
+        if self.visible_on_warn and self.user_free >= self.warn_space:
+            return ""
+        return self.format.format(
+            p=self.partition, s=size, f=free,
+            uf=self.user_free, m=self.measure,
+            r=(size - self.user_free) / size * 100)
+
+
+class TaskBox(object):
+    """Cached text layout of a window in CachedTaskList"""
+    def __init__(self, layout):
+        self.layout = layout
+        self.text = None
+        self.width = 0
+        self.text_width = None
+
+
+class CachedTaskList(widget.TaskList):
+    """
+    TaskList keeping a text layout and a scaled icon per window, redone only
+    when title, state or icon of that window changes. Hooks repaint only
+    the boxes looking different (just this widget, not the whole bar),
+    everything is repainted only if boxes moved or bar is redrawn.
+    """
+    def __init__(self, **config):
+        widget.TaskList.__init__(self, **config)
+        self._tasks = {}
+        self._widths = {}
+        self._boxes = None
+        self._pending = False
+
+    def setup_hooks(self):
+        hook.subscribe.client_name_updated(self.update)
+        hook.subscribe.focus_change(self.update)
+        hook.subscribe.float_change(self.update)
+        hook.subscribe.client_urgent_hint_changed(self.update)
+
+        hook.subscribe.net_wm_icon_change(self.invalidate_cache)
+        hook.subscribe.client_killed(self.forget)
+
+    def update(self, window=None):
+        if self._pending or (window and window not in self.windows):
+            return
+        self._pending = True
+        self.qtile.call_soon(self.redraw)
+
+    def forget(self, window):
+        self.remove_icon_cache(window)
+        task = self._tasks.pop(window.window.wid, None)
+        if task is not None:
+            task.layout.finalize()
+
+    def task(self, window):
+        text = self.get_taskname(window)
+        task = self._tasks.get(window.window.wid)
+        if task is None:
+            task = self._tasks[window.window.wid] = TaskBox(
+                self.drawer.textlayout("", self.foreground, self.font,
+                                       self.fontsize, self.fontshadow,
+                                       markup=self.markup, wrap=False))
+        if task.text != text:
+            task.layout.markup = self.markup
+            task.layout.text = task.text = text
+            del task.layout.width
+            task.width = task.layout.width + 2 * (self.padding_x + self.borderwidth)
+            task.text_width = None
+        self._widths[text] = task.width
+        return task
+
+    def box_width(self, text):
+        if text in self._widths:
+            return self._widths[text]
+        return widget.TaskList.box_width(self, text)
+
+    def get_window_icon(self, window):
+        if not window.icons:
+            return None
+        wid = window.window.wid
+        if wid in self._icons_cache:
+            return self._icons_cache[wid]
+
+        size, data = min(
+            window.icons.items(),
+            key=lambda x: abs(self.icon_size - int(x[0].split("x")[0]))
+        )
+        width, height = map(int, size.split("x"))
+        img = cairocffi.ImageSurface.create_for_data(
+            data, cairocffi.FORMAT_ARGB32, width, height)
+        # Scaled once here, drawing is then a plain copy
+        scale = self.icon_size / height
+        surface = cairocffi.ImageSurface(cairocffi.FORMAT_ARGB32,
+                                         int(width * scale + 0.5),
+                                         self.icon_size)
+        ctx = cairocffi.Context(surface)
+        ctx.scale(scale, scale)
+        ctx.set_source_surface(img)
+        ctx.paint()
+        pattern = cairocffi.SurfacePattern(surface)
+        self._icons_cache[wid] = pattern
+        return pattern
+
+    def draw(self):
+        self._boxes = None
+        self.redraw()
+
+    def redraw(self):
+        self._pending = False
+        self._widths = {}
+        tasks = [self.task(w) for w in self.windows]
+        boxes = []
+        offset = self.margin_x
+        for (w, icon, text, bw), task in zip(self.calc_box_widths(), tasks):
+            if w.urgent:
+                border = self.urgent_border
+                text_color = border
+            elif w is w.group.currentWindow:
+                border = self.border
+                text_color = border
+            else:
+                border = self.unfocused_border or (self.background or
+                                                   self.bar.background)
+                text_color = self.foreground
+
+            if self.highlight_method == 'text':
+                border = self.bar.background
+            else:
+                text_color = self.foreground
+            boxes.append((offset, bw, task, text, border, text_color, icon))
+            offset += bw + self.spacing
+        self._box_end_positions = [box[0] + box[1] for box in boxes]
+
+        old, self._boxes = self._boxes, boxes
+        if old is None or [b[:2] for b in old] != [b[:2] for b in boxes]:
+            self.drawer.clear(self.background or self.bar.background)
+            for box in boxes:
+                self.paint_box(*box)
+            self.drawer.draw(offsetx=self.offset, width=self.width)
+            return
+
+        changed = [new for new, prev in zip(boxes, old) if new != prev]
+        if not changed:
+            return
+        self.drawer.set_source_rgb(self.background or self.bar.background)
+        for box in changed:
+            self.drawer.ctx.rectangle(box[0] - self.borderwidth, 0,
+                                      box[1] + 2 * self.borderwidth,
+                                      self.bar.height)
+        self.drawer.ctx.fill()
+        for box in changed:
+            self.paint_box(*box)
+        start = int(max(0, changed[0][0] - self.borderwidth))
+        end = min(self.width, changed[-1][0] + changed[-1][1] + self.borderwidth)
+        self.bar.compose(self.drawer, offsetx=self.offset + start,
+                         width=int(math.ceil(end - start)), srcx=start)
+
+    def paint_box(self, offset, bw, task, text, border, text_color, icon):
+        icon_padding = (self.icon_size + self.padding_x) if icon else 0
+        text_width = bw - 2 * self.padding_x - icon_padding
+        if task.text_width != text_width:
+            task.layout.width = task.text_width = text_width
+        task.layout.colour = text_color
+        framed = task.layout.framed(
+            self.borderwidth,
+            border,
+            [self.padding_x + icon_padding, self.padding_x],
+            self.padding_y
+        )
+        if self.highlight_method == 'block':
+            framed.draw_fill(offset, self.margin_y, self.rounded)
+        else:
+            framed.draw(offset, self.margin_y, self.rounded)
+        if icon:
+            self.draw_icon(icon, offset)
+
+
+class MixerVolume(Scheduled, widget.Volume):
+    """
+    Volume widget driven by alsa_mixer change events instead of polling
+    amixer. Falls back to widget.Volume polling if events are not available.
+    """
+    def timer_setup(self):
+        if not alsa_mixer.watch(self.qtile, self.refresh):
+            widget.Volume.timer_setup(self)
+            return
+        if self.theme_path:
+            self.setup_images()
+        self.refresh(alsa_mixer.volume())
+
+    def refresh(self, volume):
+        if volume != self.volume:
+            self.volume = volume
+            self._update_drawer()
+            self.bar.draw()
+
+    def get_volume(self):
+        volume = alsa_mixer.volume()
+        return widget.Volume.get_volume(self) if volume is None else volume
+
+    def button_press(self, x, y, button):
+        if button == 4:
+            alsa_mixer.change(self.qtile, self.step)
+        elif button == 5:
+            alsa_mixer.change(self.qtile, -self.step)
+        elif button == 1:
+            alsa_mixer.toggle_mute()
+        else:
+            widget.Volume.button_press(self, x, y, button)
+
+
+class KbddLayout(widget.KeyboardKbdd):
+    """
+    KeyboardKbdd sharing one kbdd subscription with other instances.
+    Updated by layoutChanged signal only, without polling and without
+    running ps to find kbdd.
+    """
+    def _check_kbdd(self):
+        return True
+
+    def _dbus_init(self):
+        pass
+
+    def timer_setup(self):
+        self.update(self.keyboard)
+        if not kbdd.subscribe(self._on_layout):
+            logger.warning('python-dbus is not available, kbdd layout is not shown')
+
+    def _on_layout(self, index):
+        if self.colours:
+            self._set_colour(index)
+        self.keyboard = self.configured_keyboards[index] \
+            if index < len(self.configured_keyboards) else str(index)
+        self.update(self.keyboard)
+
+
+class XkbCapsNumLockIndicator(Scheduled, widget.CapsNumLockIndicator):
+    """
+    CapsNumLockIndicator redrawn on XKB StateNotify events received on
+    qtile's own X connection. Falls back to polling `xset q` if XKB events
+    can't be selected (e.g. xcffib without xkb module).
+    """
+    def timer_setup(self):
+        try:
+            self._select_events()
+        except Exception:
+            logger.exception('cannot select XKB events, polling lock state')
+            widget.CapsNumLockIndicator.timer_setup(self)
+            return
+        self.refresh()
+
+    def _select_events(self):
+        if xkb is None:
+            raise RuntimeError('xcffib has no xkb module')
+        self.xkb = self.qtile.conn.conn(xkb.key)
+        self.xkb.UseExtension(1, 0).reply()
+        self.xkb.SelectEvents(xkb.ID.UseCoreKbd, xkb.EventType.StateNotify, 0,
+                              xkb.EventType.StateNotify, 0, 0, {})
+        # All XKB events share one event code, depending on xcffib version
+        # they come as StateNotify or as the first XKB event.
+        self.qtile.handle_StateNotify = self.handle_xkb_event
+        self.qtile.handle_NewKeyboardNotify = self.handle_xkb_event
+
+    def handle_xkb_event(self, e):
+        self.refresh(getattr(e, 'lockedMods', None))
+
+    def refresh(self, locked=None):
+        if locked is None:
+            locked = self.xkb.GetState(xkb.ID.UseCoreKbd).reply().lockedMods
+        caps = locked & xcbq.ModMasks['lock']
+        num = locked & self.qtile.numlockMask
+        self.update('Caps %s Num %s' % ('on' if caps else 'off', 'on' if num else 'off'))
+
+
+class DamageBar(bar.Bar):
+    """
+    Bar composing widgets in an off-screen backing pixmap.
+
+    Widget drawers copy into the backing pixmap and mark their span damaged
+    instead of drawing to the bar window. Damaged spans of one loop
+    iteration are merged and pushed to the window at once, with a single
+    flush. Expose is served from the backing pixmap, without redrawing
+    widgets.
+    """
+    def _configure(self, qtile, screen):
+        bar.Bar._configure(self, qtile, screen)
+        self.damaged = []
+        self.backing = Drawer(qtile, self.window.window.wid,
+                              self.width, self.height)
+        self.backing.clear(self.background)
+        for drawer in [self.drawer] + [w.drawer for w in self.widgets]:
+            drawer.draw = functools.partial(self.compose, drawer)
+
+    def compose(self, drawer, offsetx=0, offsety=0, width=None, height=None,
+                srcx=0):
+        """Copy drawer's pixmap (from srcx) to the backing pixmap"""
+        width = drawer.width if width is None else width
+        height = drawer.height if height is None else height
+        self.qtile.conn.conn.core.CopyArea(
+            drawer.pixmap, self.backing.pixmap, self.backing.gc,
+            srcx, 0, offsetx, offsety, width, height)
+        if self.horizontal:
+            self.damage(offsetx, width)
+        else:
+            self.damage(offsety, height)
+
+    def damage(self, start, length):
+        if not self.damaged:
+            self.qtile.call_soon(self.flush_damage)
+        self.damaged.append((start, start + length))
+
+    def flush_damage(self):
+        spans = []
+        for start, end in sorted(self.damaged):
+            if spans and start <= spans[-1][1]:
+                spans[-1][1] = max(spans[-1][1], end)
+            else:
+                spans.append([start, end])
+        self.damaged = []
+        for start, end in spans:
+            if self.horizontal:
+                self.push(start, 0, end - start, self.height)
+            else:
+                self.push(0, start, self.width, end - start)
+        self.qtile.conn.flush()
+
+    def push(self, x, y, width, height):
+        self.qtile.conn.conn.core.CopyArea(
+            self.backing.pixmap, self.window.window.wid, self.backing.gc,
+            x, y, x, y, width, height)
+
+    def handle_Expose(self, e):
+        self.push(e.x, e.y, e.width, e.height)
+        self.qtile.conn.flush()
+
+    def finalize(self):
+        bar.Bar.finalize(self)
+        self.backing.finalize()
+
+
 widget_defaults = dict(
     font='Ubuntu',
     fontsize=13,
@@ -716,7 +3309,7 @@ task_list_options = dict(
 
 screens = [
     Screen(
-        top=bar.Bar(
+        top=DamageBar(
             [
                 #widget.CurrentScreen(**cur_scr_options),
                 #widget.TextBox(text=u"◥", fontsize=30, padding=-1,
@@ -743,7 +3336,7 @@ screens = [
                 widget.Sep(**sep_inv_options),
                 #widget.CurrentScreen(**cur_scr2_options),
                 widget.TextBox(**wn_prefix_options),
-                widget.TaskList(**task_list_options),
+                CachedTaskList(**task_list_options),
                 #widget.WindowName(**wn_options),
                 widget.Notify(
                     background = colors[16],
@@ -764,14 +3357,16 @@ screens = [
                     padding=1,
                     **widget_defaults
                     ),
-                widget.ThermalSensor(
+                SampledThermalSensor(
                     foreground=colors[11],
                     padding=1,
+                    tag_sensor="Package id 0",
+                    update_interval=system_sampler.interval,
                     #show_tag=True,
                     ),
                 widget.Sep(**sep_inv_options),
-                widget.CPUGraph(
-                    frequency=3,
+                SampledCPUGraph(
+                    frequency=system_sampler.interval,
                     border_color="333333",
                     border_width=1,
                     fill_color="333333",
@@ -783,14 +3378,14 @@ screens = [
 #                    fmt='RAM: {MemUsed}/{MemTotal}M',
 #                    ),
                widget.Sep(**sep_inv_options),
-               widget.DF(
+               SharedDF(
                         foreground=colors[11],
                         visible_on_warn=False,
                         partition='/',
                         format='{p}:{uf}{m}',
                         padding=3,
                         ),
-                widget.DF(
+                SharedDF(
                         foreground=colors[11],
                         visible_on_warn=False,
                         partition='/home',
@@ -818,24 +3413,24 @@ screens = [
                         foreground=colors[11],
                         background=colors[17],
                         ),
-                widget.Volume(
+                MixerVolume(
                         update_interval=widgets_default_update_interval,
+                        step=5,
                         foreground=colors[11],
                         background=colors[17],
                         ),
                 #widget.KeyboardLayout(**widget_kb_layout_options),
-                widget.KeyboardKbdd(
+                KbddLayout(
                         background=colors[17],
                         **widget_kbdd_options
                         ),
-                widget.CapsNumLockIndicator(
+                XkbCapsNumLockIndicator(
                         update_interval=widgets_default_update_interval,
                         foreground=colors[16],
                         background=colors[17],
                         padding=0,
                         ),
-                widget.Clock(
-                        update_interval=2,
+                AlignedClock(
                         font="Ubuntu",
                         padding=5,
                         fontsize=16,
@@ -850,7 +3445,7 @@ screens = [
         ),
     ),
     Screen(
-        top=bar.Bar(
+        top=DamageBar(
             [
                 #widget.CurrentScreen(**cur_scr_options),
                 widget.GroupBox(**group_box_options),
@@ -862,10 +3457,10 @@ screens = [
                         ),
                 widget.TextBox(**wn_prefix_options),
                 #widget.CurrentScreen(**cur_scr2_options),
-                widget.TaskList(**task_list_options),
+                CachedTaskList(**task_list_options),
                 #widget.WindowName(**wn_options),
                 #widget.KeyboardLayout(**widget_kb_layout_options),
-                widget.KeyboardKbdd(**widget_kbdd_options),
+                KbddLayout(**widget_kbdd_options),
             ],
             24,
             background = colors[0]
@@ -888,7 +3483,7 @@ main = None
 follow_mouse_focus = False
 bring_front_click = False
 cursor_warp = False
-floating_layout = layout.Floating(float_rules=[
+floating_layout = IndexedFloating(float_rules=[
     {'wmclass': 'confirm'},
     {'wmclass': 'dialog'},
     {'wmclass': 'download'},
@@ -909,6 +3504,7 @@ floating_layout = layout.Floating(float_rules=[
     {'wmclass': 'gnome-control-center'},
     {'wmclass': 'Meld'},
 ])
+window_rules = WindowRules(floating_layout.float_rules, groups)
 
 auto_fullscreen = True
 focus_on_window_activation = "smart"
@@ -925,10 +3521,93 @@ wmname = "LG3D"
 
 # Handle multiple monitors
 @hook.subscribe.screen_change
-def restart_on_screen_change(qtile, ev):
-    qtile.log.debug('screen change event: %s' % ev)
-    qtile.xrandr_set_screens()
-    qtile.cmd_restart()
+def on_screen_change(qtile, ev):
+    logger.debug('screen change event: %s' % ev)
+    screen_change_handler.schedule(qtile)
+
+
+# Runs before dgroups' own client_new handler, which skips placed windows
+@hook.subscribe.client_new
+def window_rules_place(window):
+    window_rules.place(hook.qtile, window)
+
+
+@hook.subscribe.client_killed
+def window_rules_forget(window):
+    window_rules.forget(window)
+
+
+@hook.subscribe.client_urgent_hint_changed
+def urgent_windows_update(window):
+    urgent_windows.update(window)
+
+
+@hook.subscribe.client_focus
+@hook.subscribe.client_killed
+def urgent_windows_discard(window):
+    urgent_windows.discard(window)
+
+
+@hook.subscribe.client_new
+def window_index_add(window):
+    window_index.add(window)
+
+
+@hook.subscribe.client_killed
+def window_index_remove(window):
+    window_index.remove(window)
+
+
+@hook.subscribe.client_managed
+def window_switcher_add(window):
+    if window.group is not None:
+        window_switcher.add(window)
+
+
+@hook.subscribe.client_killed
+def window_switcher_remove(window):
+    window_switcher.remove(window)
+
+
+@hook.subscribe.client_managed
+@hook.subscribe.client_name_updated
+@hook.subscribe.client_urgent_hint_changed
+def window_state_window_changed(window):
+    window_state.window_changed(window)
+
+
+@hook.subscribe.client_killed
+def window_state_window_killed(window):
+    window_state.window_killed(window)
+
+
+@hook.subscribe.focus_change
+def window_state_focus_changed():
+    window_state.focus_changed()
+
+
+@hook.subscribe.group_window_add
+@hook.subscribe.changegroup
+@hook.subscribe.current_screen_change
+def window_state_groups_changed(*args):
+    window_state.groups_changed()
+
+
+@hook.subscribe.setgroup
+@hook.subscribe.float_change
+@hook.subscribe.layout_change
+def window_state_layout_changed(*args):
+    window_state.layout_changed()
+
+
+@hook.subscribe.client_new
+def window_processes_add(window):
+    window_processes.add(window)
+
+
+@hook.subscribe.client_killed
+def window_processes_remove(window):
+    window_processes.remove(window)
 
 
 '''
@@ -956,6 +3635,16 @@ def startup():
     """
     Run every time qtile is started
     """
+    spawn_server.start()
+    resume_watcher.watch()
+    install_commands(hook.qtile)
+    screen_change_handler.install(hook.qtile)
+    # Monitors are configured off the event loop, screens follow when done
+    screen_change_handler.schedule(hook.qtile)
+    perf.install(hook.qtile)
+    window_rules.install(hook.qtile)
+    urgent_windows.install()
+    config_log.install(hook.qtile)
     #lazy.group["4:msg"].toscreen()
     #qtile.screens[1].setGroup("4:msg")
     #xrandr_set_screens()
@@ -963,30 +3652,32 @@ def startup():
     #qtile.screens[1].setGroup("4:msg")
 
 
+# Steps run by startup_once, concurrently where "after" allows
+wallpaper_path = home + '/Pictures/Wallpapers/backgrounds/MistyMorning.jpg'
+startup_tasks = [
+    # Autostart shell script
+    StartupTask("autostart", [home + "/.config/qtile/autostart.sh"]),
+    # Set up keyboard layouts
+    StartupTask("xkb-layout", ["setxkbmap", "-layout", "us, ru, ua"]),
+    #StartupTask("xkb-option", ["setxkbmap", "-option", "grp:alt_shift_toggle"], after=["xkb-layout"]),
+    StartupTask("xkb-option", ["setxkbmap", "-option", "grp:shift_caps_toggle"], after=["xkb-layout"]),
+    # Launch kbdd daemon - needed for keyboard layout indicator widget
+    StartupTask("kbdd", ["kbdd"], after=["xkb-option"], once=True),
+    StartupTask("nm-applet", ["nm-applet"], once=True),
+    # Set up wallpaper
+    StartupTask("wallpaper", ["feh", "--bg-scale", wallpaper_path]),
+]
+startup_report_path = home + '/.cache/qtile-startup.log'
+
+
 @hook.subscribe.startup_once
 def startup_once():
     """
     Run after qtile is started very first time
     """
 
-    home = os.path.expanduser("~")
-
-    # Autostart shell script
-    subprocess.call([home + "/.config/qtile/autostart.sh"])
-
-    # Set up keyboard layouts
-    os.system("setxkbmap -layout 'us, ru, ua'")
-    #os.system("setxkbmap -option 'grp:alt_shift_toggle'")
-    os.system("setxkbmap -option 'grp:shift_caps_toggle'")
-
-    # Launch kbdd daemon - needed for keyboard layout indicator widget
-    execute_once("kbdd")
-    execute_once("nm-applet")
-
-    # Set up wallpaper
-    wallpaper_path = '~/Pictures/Wallpapers/backgrounds/MistyMorning.jpg'
-    os.system('feh --bg-scale ' + wallpaper_path)
-
     # Fix antialiasing in Netbeans
     os.environ["_JAVA_OPTIONS"] = '-Dswing.aatext=TRUE -Dawt.useSystemAAFontSettings=on'
 
+    StartupPipeline(startup_tasks, startup_report_path).start()
+
@@ -1,17 +1,53 @@
 #!/usr/bin/env python3
 
 from libqtile.command import Client
+import mmap
+import json
+import os
+import struct
 import subprocess
 import re
 
+# Snapshot written by WindowStateFile in config.py
+STATE_PATH = os.path.join(os.environ.get('XDG_RUNTIME_DIR', '/tmp'),
+                          'qtile-state' + os.environ.get('DISPLAY', ''))
+HEADER = struct.Struct("<4sQI")
+
+
+def read_state(path=STATE_PATH, retries=10):
+    """Read qtile state snapshot without IPC, None if it is not available"""
+    try:
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    with mm:
+        for i in range(retries):
+            magic, version, length = HEADER.unpack_from(mm, 0)
+            if magic != b"QTWS":
+                return None
+            if version % 2:
+                # Being written right now
+                continue
+            if HEADER.size + length > len(mm):
+                # File has grown after we have mapped it
+                return read_state(path, retries - i - 1) if retries > 1 else None
+            payload = mm[HEADER.size:HEADER.size + length]
+            if HEADER.unpack_from(mm, 0)[1] == version:
+                return json.loads(payload.decode('utf-8'))
+    return None
+
+
 # connect to Qtile
 c = Client()
 
 # get info of windows
+state = read_state()
+windows = state["windows"] if state else c.windows()
 wins = []
 id_map = {}
 id = 0
-for win in c.windows():
+for win in windows:
     if win["group"]:
         wins.append(bytes("%i: %s (%s)" % (id, win["name"], win["group"]),
             'utf-8'))
@@ -32,12 +68,5 @@ out = p.communicate(b"\n".join(wins))[0]
 id = int(re.match(b"^\d+", out).group())
 win = id_map[id]
 
-# focusing selected window
-g = c.group[win["group"]]
-g.toscreen()
-w = g.window[win["id"]]
-for i in range(len(g.info()["windows"])):
-    insp = w.inspect()
-    if insp['attributes']['map_state']:
-        break
-    g.next_window()
+# focusing selected window, switching group and screen if needed
+c.focus_window(win["id"])
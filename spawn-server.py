@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+
+# Spawn server for qtile config.
+#
+# Started once by qtile, reads one JSON argument list per line from stdin
+# and starts it as a new session. Keeping this process small makes spawning
+# cheap, unlike forking the whole (and growing) qtile process.
+# Exits when qtile closes the pipe (on exit or restart).
+
+import json
+import os
+import signal
+import subprocess
+import sys
+
+
+def reset_sigchld():
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+
+
+def spawn(args):
+    # Children must not get our stdin, it's the pipe requests come from
+    if hasattr(os, 'posix_spawnp'):
+        os.posix_spawnp(args[0], args, os.environ, setsid=True,
+                        setsigdef=(signal.SIGCHLD, ),
+                        file_actions=[(os.POSIX_SPAWN_OPEN, 0, os.devnull,
+                                       os.O_RDONLY, 0)])
+    else:
+        subprocess.Popen(args, start_new_session=True, preexec_fn=reset_sigchld,
+                         stdin=subprocess.DEVNULL)
+
+
+def main():
+    # Let kernel reap our children
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    for line in sys.stdin:
+        try:
+            args = json.loads(line)
+            spawn(args)
+        except (ValueError, OSError, IndexError) as e:
+            print("spawn-server: %s: %s" % (line.strip(), e), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()